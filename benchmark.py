@@ -0,0 +1,342 @@
+"""
+Offline benchmarks of the database update (update_db) and the morning notification (notify_user).
+
+IMDB, OMDb and the Telegram Bot API are replaced by a local fake server, and the bot's tables are
+created in a local PostgreSQL database given by the BENCH_DB_NAME, BENCH_DB_HOST, BENCH_DB_PORT and
+BENCH_DB_USER environment variables. The movies, movie_releases, users, omdb_cache and sync_state tables
+of that database are emptied by the benchmarks, so never point it to a database that is in use.
+
+Usage:
+    python3 benchmark.py [--titles 100 1000 5000] [--users 1000 10000] [--omdb-latency 0.05]
+                         [--save-baseline] [--baseline benchmark_baseline.json]
+"""
+
+from database import DatabaseManager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from refresh import RefreshCoordinator
+from subscriber_buffer import SubscriberBuffer
+from telegram import Bot
+from telegram.utils.request import Request
+import argparse
+import collections
+import datetime
+import json
+import logging
+import main
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+TOKEN = '123456:benchmark'
+BLOCKED_CHAT_ID_MODULO = 50 # Every chat_id divisible by this has blocked the bot
+REGRESSION_TOLERANCE = 0.2 # A metric more than 20% worse than the baseline is reported as a regression
+
+# Benchmark-only queries
+TRUNCATE_TABLES = 'TRUNCATE movies, movie_releases, users, omdb_cache, sync_state;'
+TRUNCATE_SYNC_STATE = 'TRUNCATE sync_state;'
+TRUNCATE_USERS = 'TRUNCATE users;'
+INSERT_SYNTHETIC_USERS = "INSERT INTO users (chat_id, first_name, username) \
+                SELECT g, 'User' || g, 'user' || g FROM generate_series(1, %s) AS g;"
+
+class FakeUpstreams:
+    '''
+    Local HTTP server standing in for the IMDB calendar page, the OMDb API, movie posters and the Telegram Bot API.
+    '''
+
+    def __init__(self, titles, omdb_latency, telegram_rate):
+        self.titles = titles # Number of movies on the calendar page
+        self.omdb_latency = omdb_latency # Seconds slept before each OMDb response
+        self.telegram_rate = telegram_rate # Messages per second accepted before answering 429
+        self.calls = collections.Counter() # Upstream name -> number of HTTP calls
+        self.telegram_window = (0, 0) # (second, number of messages in that second)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler_class())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, upstream):
+        with self.lock:
+            self.calls[upstream] += 1
+
+    def calendar_page(self):
+        '''
+        Returns an IMDB-like calendar page listing the movies, about ten per release date, starting today.
+        '''
+        parts = ['<html><body><div id="nav"></div><div id="main"><h1>Release Calendar</h1>']
+        today = datetime.date.today()
+        for i in range(self.titles):
+            if i % 10 == 0:
+                if i:
+                    parts.append('</ul>')
+                release_date = today + datetime.timedelta(days=i // 10)
+                parts.append('<h4>{} {} {}</h4><ul>'.format(release_date.day, release_date.strftime('%B'), release_date.year))
+            parts.append('<li>\n<a href="/title/tt{:07d}/?ref_=rlm">Synthetic Movie {}</a> ({})\n</li>'
+                            .format(i, i, today.year))
+        parts.append('</ul></div></body></html>')
+        return ''.join(parts).encode('utf-8')
+
+    def omdb_response(self, imdb_id):
+        time.sleep(self.omdb_latency)
+        return {
+            'Response': 'True',
+            'Runtime': '120 min',
+            'Genre': 'Action, Drama',
+            'Director': 'Jane Doe',
+            'Writer': 'John Doe',
+            'Actors': 'Actor One, Actor Two, Actor Three',
+            'Plot': 'A synthetic movie ({}) used for benchmarking. '.format(imdb_id) * 4,
+            'Language': 'English',
+            'Country': 'Singapore',
+            'Poster': '{}/poster/{}.jpg'.format(self.url, imdb_id)
+        }
+
+    def telegram_response(self, method, body):
+        '''
+        Returns the (status, JSON body) answered by the fake Bot API.
+        '''
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': int(TOKEN.split(':')[0]), 'is_bot': True, 'first_name': 'Benchmark',
+                                                'username': 'benchmark_bot'}}
+        if method == 'answerCallbackQuery':
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(body.get('chat_id', 0))
+        if chat_id % BLOCKED_CHAT_ID_MODULO == 0:
+            return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+
+        with self.lock:
+            second = int(time.monotonic())
+            window_second, window_count = self.telegram_window
+            window_count = window_count + 1 if window_second == second else 1
+            self.telegram_window = (second, window_count)
+        if window_count > self.telegram_rate:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                        'parameters': {'retry_after': 1}}
+
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': body.get('text', '')}
+        if method == 'sendPhoto':
+            file_id = 'photo-{}'.format(body.get('photo', ''))
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 300, 'height': 450}]
+        return 200, {'ok': True, 'result': message}
+
+    def __handler_class(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path.startswith('/calendar'):
+                    upstreams.count('imdb')
+                    etag = '"calendar-{}-{}"'.format(upstreams.titles, datetime.date.today())
+                    if self.headers.get('If-None-Match') == etag:
+                        self.__reply(304, b'', 'text/html; charset=utf-8', etag=etag)
+                    else:
+                        self.__reply(200, upstreams.calendar_page(), 'text/html; charset=utf-8', etag=etag)
+                elif self.path.startswith('/omdb'):
+                    upstreams.count('omdb')
+                    imdb_id = self.path.split('i=')[1].split('&')[0]
+                    self.__reply(200, json.dumps(upstreams.omdb_response(imdb_id)).encode('utf-8'), 'application/json')
+                elif self.path.startswith('/poster'):
+                    upstreams.count('poster')
+                    self.__reply(200, b'\xff\xd8\xff', 'image/jpeg')
+                else:
+                    self.__reply(404, b'', 'text/plain')
+
+            def do_HEAD(self):
+                upstreams.count('poster')
+                self.__reply(200, b'', 'image/jpeg')
+
+            def do_POST(self):
+                upstreams.count('telegram')
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[1]
+                status, response = upstreams.telegram_response(method, json.loads(body or b'{}'))
+                self.__reply(status, json.dumps(response).encode('utf-8'), 'application/json')
+
+            def __reply(self, status, body, content_type, etag=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class CountingCursor:
+    '''
+    Cursor wrapper counting the statements sent to the database.
+    '''
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args, **kwargs):
+        self.counter['queries'] += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class CountingDatabaseManager(DatabaseManager):
+    '''
+    DatabaseManager counting the statements and transactions it runs.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = collections.Counter()
+        self.counter_lock = threading.Lock()
+
+    def run(self, work):
+        local_counter = collections.Counter()
+        result = super().run(lambda cursor: work(CountingCursor(cursor, local_counter)))
+        with self.counter_lock:
+            self.counter.update(local_counter)
+            self.counter['transactions'] += 1
+        return result
+
+def measure(name, function, db_mgr, upstreams):
+    '''
+    Runs function() and returns its wall time, peak Python memory, queries and HTTP calls as a dict.
+    '''
+    db_mgr.counter.clear()
+    upstreams.calls.clear()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    function()
+    wall_time = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        'wall_time_s': round(wall_time, 3),
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 2),
+        'queries': db_mgr.counter['queries'],
+        'transactions': db_mgr.counter['transactions'],
+        'http_calls': dict(upstreams.calls)
+    }
+    print("{}: {}".format(name, result))
+    return result
+
+def bench_update_db(db_mgr, upstreams, titles):
+    '''
+    Benchmarks a cold update (empty OMDb cache), a warm update (cached OMDb responses)
+    and an update of an unchanged calendar of the given size.
+    '''
+    def warm_update():
+        # Forget the last calendar, so that it is synced again from the OMDb cache
+        db_mgr.run(lambda cursor: cursor.execute(TRUNCATE_SYNC_STATE))
+        main.update_db(None)
+
+    upstreams.titles = titles
+    db_mgr.run(lambda cursor: cursor.execute(TRUNCATE_TABLES))
+    db_mgr.invalidate_catalog()
+    return {
+        'update_db[titles={}, cold]'.format(titles): measure('update_db cold', lambda: main.update_db(None), db_mgr, upstreams),
+        'update_db[titles={}, warm]'.format(titles): measure('update_db warm', warm_update, db_mgr, upstreams),
+        'update_db[titles={}, unchanged]'.format(titles): measure('update_db unchanged', lambda: main.update_db(None), db_mgr, upstreams)
+    }
+
+def bench_notify_user(db_mgr, upstreams, users, broadcast_workers):
+    '''
+    Benchmarks the morning notification to the given number of users, with the last calendar in the db.
+    '''
+    db_mgr.run(lambda cursor: cursor.execute(TRUNCATE_USERS))
+    db_mgr.run(lambda cursor: cursor.execute(INSERT_SYNTHETIC_USERS, (users, )))
+    bot = Bot(TOKEN, base_url=upstreams.url + '/bot', request=Request(con_pool_size=broadcast_workers + 4))
+    context = types.SimpleNamespace(bot=bot)
+    return {
+        'notify_user[users={}]'.format(users): measure('notify_user', lambda: main.notify_user(context), db_mgr, upstreams)
+    }
+
+def compare(results, baseline):
+    '''
+    Returns the list of (case, metric, baseline value, new value) that regressed compared to the baseline.
+    '''
+    regressions = []
+    for case, metrics in results.items():
+        for metric in ('wall_time_s', 'peak_memory_mb', 'queries'):
+            old, new = baseline.get(case, {}).get(metric), metrics[metric]
+            if old and new > old * (1 + REGRESSION_TOLERANCE):
+                regressions.append((case, metric, old, new))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of update_db and notify_user.')
+    parser.add_argument('--titles', type=int, nargs='+', default=[100, 1000, 5000], help='Calendar sizes')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000], help='Numbers of subscribers')
+    parser.add_argument('--omdb-latency', type=float, default=0.05, help='Seconds before each fake OMDb response')
+    parser.add_argument('--telegram-rate', type=int, default=1000, help='Messages per second before the fake Bot API answers 429')
+    parser.add_argument('--broadcast-rate', type=int, default=900, help='BROADCAST_RATE used by notify_user')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='Baseline file to compare to or save')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    return parser.parse_args()
+
+def main_benchmark():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    upstreams = FakeUpstreams(args.titles[0], args.omdb_latency, args.telegram_rate).start()
+    os.environ['IMDB_CALENDAR_URL'] = upstreams.url + '/calendar/'
+    os.environ['OMDB_API_URL'] = upstreams.url + '/omdb/'
+    os.environ.setdefault('OMDB_API_KEY', 'benchmark')
+    os.environ['OMDB_DAILY_LIMIT'] = str(10 ** 9) # Every title is looked up, the fake OMDb has no quota
+    os.environ['BROADCAST_RATE'] = str(args.broadcast_rate)
+    broadcast_workers = int(os.getenv('BROADCAST_WORKERS', 8))
+
+    db_mgr = CountingDatabaseManager(os.getenv('BENCH_DB_NAME'), os.getenv('BENCH_DB_USER'), os.getenv('BENCH_DB_PORT'),
+                                    os.getenv('BENCH_DB_HOST'), password=os.getenv('BENCH_DB_PASSWORD', ''))
+    if not db_mgr.connect_db(with_pwd=bool(db_mgr.password)):
+        sys.exit(1)
+    db_mgr.create_tables()
+    main.DB_MGR = db_mgr
+    main.REFRESHER = RefreshCoordinator(main.refresh_db, 0)
+    main.SUBSCRIBERS = SubscriberBuffer(db_mgr) # Nothing to write, the users are inserted by bench_notify_user
+
+    results = {}
+    try:
+        for titles in args.titles:
+            results.update(bench_update_db(db_mgr, upstreams, titles))
+        for users in args.users:
+            results.update(bench_notify_user(db_mgr, upstreams, users, broadcast_workers))
+    finally:
+        upstreams.stop()
+
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for case, metric, old, new in regressions:
+            print("REGRESSION {} {}: {} -> {}".format(case, metric, old, new))
+        if regressions:
+            sys.exit(1)
+        print("No regression compared to {}".format(args.baseline))
+
+if __name__ == '__main__':
+    main_benchmark()
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+Sends a message to many chats in parallel while staying within Telegram's rate limits
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import BadRequest
+from telegram.error import NetworkError
+from telegram.error import RetryAfter
+from telegram.error import TelegramError
+from telegram.error import Unauthorized
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger()
+
+class RateLimiter:
+    '''
+    Thread-safe limiter allowing at most "rate" sends per second overall (token bucket)
+    and at most one send per "per_chat_interval" seconds to the same chat.
+    '''
+
+    def __init__(self, rate, per_chat_interval):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.paused_until = 0 # Set when Telegram asks us to back off (RetryAfter)
+        self.last_sent = {} # chat_id -> time of the last send to that chat
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        '''
+        Block until a message can be sent to the given chat.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                wait = max(self.paused_until - now,
+                            self.last_sent.get(chat_id, -self.per_chat_interval) + self.per_chat_interval - now,
+                            (1 - self.tokens) / self.rate)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self.last_sent[chat_id] = now
+                    if len(self.last_sent) > 10000:
+                        # Forget chats that are no longer throttled so memory stays flat on large broadcasts
+                        self.last_sent = {chat: sent for chat, sent in self.last_sent.items()
+                                            if now - sent < self.per_chat_interval}
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''
+        Stop every sender for the given number of seconds.
+        '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class BroadcastReport:
+    '''
+    Outcome of a broadcast.
+    '''
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.blocked_chat_ids = [] # Chats that blocked the bot (Unauthorized)
+        self.elapsed = 0.0 # Wall time in seconds
+
+    @property
+    def throughput(self):
+        '''
+        Messages sent per second.
+        '''
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return "sent {}, blocked {}, failed {}, retries {} in {:.1f}s ({:.1f} msg/s)".format(
+                self.sent, len(self.blocked_chat_ids), self.failed, self.retries, self.elapsed, self.throughput)
+
+class Broadcaster:
+
+    def __init__(self, bot, max_workers=None, rate=None, per_chat_interval=1.0, max_retries=3):
+        self.bot = bot
+        self.max_workers = max_workers or int(os.getenv('BROADCAST_WORKERS', 8)) # Concurrent senders
+        rate = rate or float(os.getenv('BROADCAST_RATE', 25)) # Messages per second (Telegram allows about 30)
+        self.limiter = RateLimiter(rate, per_chat_interval)
+        self.max_retries = max_retries
+        self.report = None
+        self.lock = threading.Lock()
+
+    def broadcast(self, messages, **kwargs):
+        '''
+        Sends every message and returns a BroadcastReport.
+        Extra keyword arguments (e.g. parse_mode) are passed to bot.send_message.
+
+        @param messages: Iterable of (chat_id, text) tuples. It is consumed lazily,
+                         so a generator of any size can be passed.
+        '''
+        self.report = BroadcastReport()
+        start_time = time.monotonic()
+
+        # Bound the number of queued sends so that the messages iterable is not consumed all at once
+        in_flight = threading.BoundedSemaphore(self.max_workers * 2)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chat_id, text in messages:
+                in_flight.acquire()
+                future = executor.submit(self.__send, chat_id, text, kwargs)
+                future.add_done_callback(lambda _: in_flight.release())
+
+        self.report.elapsed = time.monotonic() - start_time
+        return self.report
+
+    def __send(self, chat_id, text, kwargs):
+        '''
+        Sends a message to a chat, backing off and retrying when Telegram asks us to slow down
+        or when the network fails.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(chat_id)
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.__count('sent')
+                return
+            except Unauthorized:
+                # User has blocked the bot
+                with self.lock:
+                    self.report.blocked_chat_ids.append(chat_id)
+                return
+            except RetryAfter as e:
+                LOGGER.warning("Flood limit reached, retrying in {}s".format(e.retry_after))
+                self.limiter.pause(e.retry_after)
+            except BadRequest as e:
+                LOGGER.warning("Failed to send message to {}: {}".format(chat_id, e))
+                break
+            except NetworkError:
+                # Includes TimedOut
+                time.sleep(2 ** attempt)
+            except TelegramError as e:
+                LOGGER.warning("Failed to send message to {}: {}".format(chat_id, e))
+                break
+            if attempt < self.max_retries:
+                self.__count('retries')
+        self.__count('failed')
+
+    def __count(self, field):
+        with self.lock:
+            setattr(self.report, field, getattr(self.report, field) + 1)
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+In-memory snapshot of the movies table
+"""
+
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import Counter
+import re
+import unidecode
+
+MIN_TRIGRAM_SIMILARITY = 0.3 # Minimum similarity of the whole title for a typo-tolerant match
+MIN_WORD_SIMILARITY = 0.7 # Minimum similarity of a query word and a title word to count as a typo of it
+MIN_WORDS_SIMILARITY = 0.6 # Minimum similarity of the query words to their closest title words, weighted by length
+
+def normalize_title(title):
+    '''
+    Returns the form of a title used for lookups (ASCII, lowercase, no surrounding whitespace).
+    '''
+    return unidecode.unidecode(title).strip().lower()
+
+def search_key(title):
+    '''
+    Returns the form of a title used for searches: normalized, with punctuation replaced by spaces.
+    '''
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', normalize_title(title)).split())
+
+def trigrams(key):
+    '''
+    Returns the set of character trigrams of a search key, padded so that word starts count more.
+    '''
+    padded = '  ' + key + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b):
+    '''
+    Returns the number of inserted, deleted or substituted characters, or swapped adjacent characters,
+    needed to turn a into b (optimal string alignment distance).
+    '''
+    previous_row, row = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        previous_row, before_row, row = row, previous_row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before_row[j - 2] + 1)
+    return row[-1]
+
+def word_similarity(a, b):
+    '''
+    Returns the similarity of two words, from 0 to 1 (1 - edit distance / length of the longest word).
+    '''
+    return 1 - edit_distance(a, b) / max(len(a), len(b))
+
+class TitleIndex:
+    '''
+    Search index over movie titles supporting exact, prefix, word-prefix and typo-tolerant (trigram) matches.
+    '''
+
+    def __init__(self, movies):
+        self.movies = movies
+        keys = [search_key(movie.title) for movie in movies]
+        self.sorted_titles = sorted((key, i) for i, key in enumerate(keys)) # For full title prefix lookups
+        self.sorted_words = sorted((word, i) for i, key in enumerate(keys) for word in set(key.split()))
+        self.trigram_counts = []
+        self.trigram_postings = {} # Trigram -> list of movie indices
+        for i, key in enumerate(keys):
+            key_trigrams = trigrams(key)
+            self.trigram_counts.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                self.trigram_postings.setdefault(trigram, []).append(i)
+        self.word_titles = {} # Title word -> list of movie indices
+        for word, i in self.sorted_words:
+            self.word_titles.setdefault(word, []).append(i)
+        self.word_trigram_postings = {} # Trigram -> list of title words, to find the words close to a query word
+        for word in self.word_titles:
+            for trigram in trigrams(word):
+                self.word_trigram_postings.setdefault(trigram, []).append(word)
+
+    def search(self, query, limit=5):
+        '''
+        Returns up to "limit" movies matching the query, best match first, as a list of (score, Movie) tuples.
+        Scores are 1 for an exact title match, 0.9 for a title prefix, 0.8 when every query word starts a word
+        of the title, and below 0.7 for titles that only look similar (e.g. typos).
+        '''
+        key = search_key(query)
+        if not key:
+            return []
+        scores = {}
+
+        # Exact title and title prefix
+        for title, i in self.__prefix_range(self.sorted_titles, key):
+            scores[i] = 1.0 if title == key else 0.9
+
+        # Every query word is the start of a word of the title
+        candidates = None
+        for word in key.split():
+            matches = {i for _, i in self.__prefix_range(self.sorted_words, word)}
+            candidates = matches if candidates is None else candidates & matches
+        for i in candidates:
+            scores.setdefault(i, 0.8)
+
+        # Similar titles, only if there are not enough better matches
+        if len(scores) < limit:
+            similarities = self.__words_similarities(key.split())
+            query_trigrams = trigrams(key)
+            shared_counts = Counter(i for trigram in query_trigrams for i in self.trigram_postings.get(trigram, ()))
+            for i, shared in shared_counts.items():
+                similarity = shared / (len(query_trigrams) + self.trigram_counts[i] - shared)
+                if similarity >= MIN_TRIGRAM_SIMILARITY:
+                    similarities[i] = max(similarity, similarities.get(i, 0))
+            for i, similarity in similarities.items():
+                scores.setdefault(i, 0.7 * similarity)
+
+        ranked = sorted(scores, key=lambda i: (-scores[i], self.movies[i].release_date))
+        return [(scores[i], self.movies[i]) for i in ranked[:limit]]
+
+    def __words_similarities(self, query_words):
+        '''
+        Returns a dict of movie index -> similarity of the title to the query words, for the titles similar
+        enough (see MIN_WORDS_SIMILARITY). Each query word is compared to the closest word of the title, so that
+        a typo in one word of a long title (e.g. "avangers" for "The Avengers") is not diluted by the other words.
+        '''
+        total_length = sum(len(word) for word in query_words)
+        weighted_similarities = Counter() # Movie index -> sum of query word length * similarity to the closest word
+        for query_word in query_words:
+            # Words sharing a trigram with the query word, of a length that allows a close enough match
+            max_length_difference = int(len(query_word) * (1 - MIN_WORD_SIMILARITY) / MIN_WORD_SIMILARITY)
+            candidates = {word for trigram in trigrams(query_word) for word in self.word_trigram_postings.get(trigram, ())
+                            if abs(len(word) - len(query_word)) <= max_length_difference}
+            best_similarities = {} # Movie index -> similarity of the closest word of the title
+            for word in candidates:
+                similarity = word_similarity(query_word, word)
+                if similarity < MIN_WORD_SIMILARITY:
+                    continue
+                for i in self.word_titles[word]:
+                    best_similarities[i] = max(similarity, best_similarities.get(i, 0))
+            for i, similarity in best_similarities.items():
+                weighted_similarities[i] += len(query_word) * similarity
+        return {i: weighted / total_length for i, weighted in weighted_similarities.items()
+                if weighted / total_length >= MIN_WORDS_SIMILARITY}
+
+    def __prefix_range(self, sorted_entries, prefix):
+        '''
+        Yields the (key, index) entries of a sorted list whose key starts with the prefix.
+        '''
+        position = bisect_left(sorted_entries, (prefix, ))
+        while position < len(sorted_entries) and sorted_entries[position][0].startswith(prefix):
+            yield sorted_entries[position]
+            position += 1
+
+class MovieCatalog:
+    '''
+    Immutable snapshot of the movies in the db, indexed by imdb_id, normalized title and release date.
+    A new catalog is built after each sync and swapped in as a whole, so readers never see a partial update.
+    '''
+
+    def __init__(self, movies):
+        self.movies = sorted(movies, key=lambda movie: movie.release_date) # Sorted by release date
+        self.by_imdb_id = {movie.imdb_id: movie for movie in self.movies}
+        self.by_title = {} # Normalized title -> list of Movie objects
+        self.by_release_date = {} # Release date -> list of Movie objects
+        for movie in self.movies:
+            self.by_title.setdefault(normalize_title(movie.title), []).append(movie)
+            self.by_release_date.setdefault(movie.release_date, []).append(movie)
+        self.title_index = TitleIndex(self.movies)
+        self.release_dates = [movie.release_date for movie in self.movies] # Sorted, for date range lookups
+
+    def get_movies_by_title(self, title):
+        '''
+        Returns the movies matching the given title (case-insensitive) as a list of Movie objects.
+        '''
+        return list(self.by_title.get(normalize_title(title), []))
+
+    def search_movies(self, query, limit=5):
+        '''
+        Returns up to "limit" movies whose title matches the query, best match first, as (score, Movie) tuples.
+        See TitleIndex.search.
+        '''
+        return self.title_index.search(query, limit)
+
+    def get_movies_released_between(self, start_date, end_date):
+        '''
+        Returns the movies released between the two dates (both included), sorted by release date.
+        '''
+        start = bisect_left(self.release_dates, start_date)
+        end = bisect_right(self.release_dates, end_date)
+        return self.movies[start:end]
+
+    def get_movies_released_before(self, date):
+        '''
+        Returns the movies released before the given date, sorted by release date.
+        '''
+        return self.movies[:bisect_left(self.release_dates, date)]
+
+    def __len__(self):
+        return len(self.movies)
\ No newline at end of file
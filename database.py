@@ -2,158 +2,699 @@
 Deals with database stuff for the bot
 """
 
+from catalog import MovieCatalog
+from movie import DETAIL_FIELDS
 from movie import Movie
 from user import User
+import json
 import logging
+import metrics
+import os
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import sql_queries as queries
+import threading
+import time
 import unidecode
+import uuid
 
 LOGGER = logging.getLogger()
 
+CATALOG_VERSION_KEY = 'catalog_version' # sync_state key changed by every write to the movies, see refresh_catalogs
+
 class DatabaseManager:
 
+    ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError) # Errors caused by the values written, not by the db
+
     def __init__(self, db_name, user, port, host, password=''):
         self.db_name = db_name
         self.user = user
         self.password = password
         self.port = port
         self.host = host
-        self.connection = None
-        self.cursor = None
+        self.pool = None # Pool of connections, each query checks one out for the duration of its transaction
+        self.pool_semaphore = None # Blocks callers when every connection of the pool is checked out
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', 10))
+        self.health_check_interval = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', 60)) # Seconds
+        self.statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 0)) # Milliseconds, 0 for no timeout
+        self.last_used = {} # id(connection) -> time it was last returned to the pool
+        self.users_batch_size = int(os.getenv('USERS_BATCH_SIZE', 1000)) # Users loaded per query by iter_users
+        # Regions whose movie releases are tracked (e.g. 'sg,my,au'), the first one is the default region
+        self.regions = [region.strip().lower() for region in os.getenv('REGIONS', 'sg').split(',') if region.strip()]
+        self.default_region = self.regions[0]
+        self.catalogs = {} # Region -> in-memory MovieCatalog of the movies released there, loaded on first read
+        self.catalog_lock = threading.Lock()
+        self.catalog_version = None # CATALOG_VERSION_KEY value the loaded catalogs were checked against
     
     def connect_db(self, with_pwd):
         '''
-        Attempts to connect to the database.
-        Returns a connection object if success, exit if fail.
+        Attempts to create a pool of connections to the database.
+        Returns the connection pool if success, None if fail.
 
         @param with_pwd: If True, connect to db with a password. Else, connect to db without password.
         '''
+        connect_kwargs = {
+            'user': self.user,
+            'host': self.host,
+            'port': self.port,
+            'database': self.db_name
+        }
+        if with_pwd:
+            connect_kwargs['password'] = self.password
+        if self.statement_timeout:
+            connect_kwargs['options'] = '-c statement_timeout={}'.format(self.statement_timeout)
+
         try:
-            if with_pwd:
-                LOGGER.info("Connecting to the database {} at {} (port {}) as user {} (with password)"
-                        .format(self.db_name, self.host, self.port, self.user))
-                self.connection = psycopg2.connect(
-                    user=self.user,
-                    password=self.password,
-                    host=self.host,
-                    port=self.port,
-                    database=self.db_name
-                )
-            else:
-                LOGGER.info("Connecting to the database {} at {} (port {}) as user {}"
-                        .format(self.db_name, self.host, self.port, self.user))
-                self.connection = psycopg2.connect(
-                    user=self.user,
-                    host=self.host,
-                    port=self.port,
-                    database=self.db_name
-                )
-            self.cursor = self.connection.cursor()
+            LOGGER.info("Connecting to the database {} at {} (port {}) as user {}{} with a pool of {} connections"
+                    .format(self.db_name, self.host, self.port, self.user, " (with password)" if with_pwd else "",
+                            self.pool_size))
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.pool_size, **connect_kwargs)
+            self.pool_semaphore = threading.BoundedSemaphore(self.pool_size)
         except Exception as e:
             LOGGER.error("Failed to connect to the database!")
             print(e)
-        return self.connection
+        return self.pool
+
+    def run(self, work):
+        '''
+        Runs work(cursor) in a transaction on a connection checked out from the pool, and returns its result.
+        The transaction is committed if work returns, and rolled back if it raises.
+        If the connection turns out to be lost, work is run once more on a new connection.
+        '''
+        for attempt in range(2):
+            self.pool_semaphore.acquire()
+            try:
+                connection = self.__checkout()
+                try:
+                    with connection.cursor() as cursor:
+                        result = work(cursor)
+                    connection.commit()
+                except Exception as e:
+                    lost = bool(connection.closed)
+                    if not lost:
+                        try:
+                            connection.rollback()
+                        except psycopg2.Error:
+                            lost = True
+                    self.__checkin(connection, close=lost)
+                    if lost and attempt == 0 and isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                        LOGGER.warning("Lost the database connection, retrying on a new connection: {}".format(e))
+                        continue
+                    raise
+                self.__checkin(connection)
+                return result
+            finally:
+                self.pool_semaphore.release()
+
+    def __checkout(self):
+        '''
+        Returns a healthy connection from the pool. Connections that have been idle for longer than
+        the health check interval are pinged first, and replaced if they no longer work.
+        '''
+        connection = self.pool.getconn()
+        last_used = self.last_used.get(id(connection))
+        if not connection.closed and last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return connection
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(queries.PING)
+            connection.rollback()
+        except psycopg2.Error as e:
+            LOGGER.warning("Replacing a broken database connection: {}".format(e))
+            self.__checkin(connection, close=True)
+            connection = self.pool.getconn()
+        return connection
+
+    def __checkin(self, connection, close=False):
+        '''
+        Returns a connection to the pool, closing it if it is broken.
+        '''
+        if close:
+            self.last_used.pop(id(connection), None)
+        else:
+            self.last_used[id(connection)] = time.monotonic()
+        self.pool.putconn(connection, close=close)
     
     def create_tables(self):
         '''
-        Create all the required tables (movies, users) in this db.
+        Create all the required tables (movies, users, subscriptions, omdb_cache, job_runs, sync_state) in this db.
         '''
         self.create_movies_table()
         self.create_users_table()
+        self.create_subscriptions_table()
+        self.create_omdb_cache_table()
+        self.create_job_runs_table()
+        self.create_sync_state_table()
     
     def create_movies_table(self):
         '''
         Create movies table in the db if it does not exists.
         '''
-        self.cursor.execute(queries.CREATE_MOVIES_TABLE)
-        self.connection.commit()
+        def work(cursor):
+            cursor.execute(queries.CREATE_MOVIES_TABLE)
+            cursor.execute(queries.ADD_MOVIES_POSTER_COLUMNS)
+            cursor.execute(queries.CREATE_MOVIE_RELEASES_TABLE)
+            cursor.execute(queries.CREATE_MOVIE_RELEASES_REGION_DATE_INDEX)
+            cursor.execute(queries.MIGRATE_MOVIE_RELEASES, (self.default_region, ))
+            cursor.execute(queries.DROP_MOVIES_RELEASE_DATE_INDEX)
+        self.run(work)
     
     def create_users_table(self):
         '''
         Create users table in the db if it does not exists.
         '''
-        self.cursor.execute(queries.CREATE_USERS_TABLE)
-        self.connection.commit()
+        def work(cursor):
+            cursor.execute(queries.CREATE_USERS_TABLE)
+            cursor.execute(queries.ADD_USERS_REGION_COLUMN)
+        self.run(work)
+
+    def create_subscriptions_table(self):
+        '''
+        Create subscriptions table in the db if it does not exists.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.CREATE_SUBSCRIPTIONS_TABLE))
     
+    def create_omdb_cache_table(self):
+        '''
+        Create omdb_cache table in the db if it does not exists.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.CREATE_OMDB_CACHE_TABLE))
+
+    def create_job_runs_table(self):
+        '''
+        Create job_runs table in the db if it does not exists.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.CREATE_JOB_RUNS_TABLE))
+
+    def create_sync_state_table(self):
+        '''
+        Create sync_state table in the db if it does not exists.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.CREATE_SYNC_STATE_TABLE))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
     def insert_user(self, user):
         '''
         Insert a user object into the users table. If user already exists, do nothing.
         Returns 1 if user is inserted into the db, 0 if user already exists in the db.
         '''
-        self.cursor.execute(queries.INSERT_USER, (user.chat_id, user.first_name, user.username))
-        row_count = self.cursor.rowcount
-        self.connection.commit()
-        return row_count
+        def work(cursor):
+            cursor.execute(queries.INSERT_USER, (user.chat_id, user.first_name, user.username))
+            return cursor.rowcount
+        return self.run(work)
     
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_user_regions(self):
+        '''
+        Return the users in the database as a dict of chat_id -> region (None if the user has not picked one)
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_USER_REGIONS)
+            return cursor.fetchall()
+        return {row[0]: row[1] for row in self.run(work)}
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
     def get_users(self):
         '''
         Return users in the database as a list of User objects
         '''
-        self.cursor.execute(queries.GET_USERS)
-        rows = self.cursor.fetchall()
-        users = [User(row[0], row[1], row[2]) for row in rows]
+        def work(cursor):
+            cursor.execute(queries.GET_USERS)
+            return cursor.fetchall()
+        users = [User(row[0], row[1], row[2], row[3]) for row in self.run(work)]
         return users
     
+    def iter_users(self, batch_size=None):
+        '''
+        Yields the users in the database as User objects, ordered by chat_id, loading them in batches.
+        Each batch is fetched in its own short transaction using keyset pagination on chat_id,
+        so memory use does not grow with the number of users and no connection is held between batches.
+
+        @param batch_size: Number of users loaded per query (USERS_BATCH_SIZE, 1000 by default).
+        '''
+        batch_size = batch_size or self.users_batch_size
+        last_chat_id = None
+        while True:
+            def work(cursor):
+                if last_chat_id is None:
+                    cursor.execute(queries.GET_USERS_FIRST_PAGE, (batch_size, ))
+                else:
+                    cursor.execute(queries.GET_USERS_PAGE_AFTER, (last_chat_id, batch_size))
+                return cursor.fetchall()
+            with metrics.track(metrics.DB_QUERY_SECONDS, 'query', 'iter_users'):
+                rows = self.run(work)
+
+            for row in rows:
+                yield User(row[0], row[1], row[2], row[3])
+            if len(rows) < batch_size:
+                return
+            last_chat_id = rows[-1][0]
+    
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def set_user_region(self, chat_id, region):
+        '''
+        Set the region of a user. Returns 1 if the user is updated, 0 if the user does not exists in the db.
+        '''
+        def work(cursor):
+            cursor.execute(queries.UPDATE_USER_REGION, (region, chat_id))
+            return cursor.rowcount
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
     def delete_user(self, user):
         '''
         Remove a user object from the users table.
         Returns 1 if the user is removed, 0 if user does not exists in the db.
         '''
-        self.cursor.execute(queries.DELETE_USER, (user.chat_id,))
-        row_count = self.cursor.rowcount
-        self.connection.commit()
-        return row_count
+        def work(cursor):
+            cursor.execute(queries.DELETE_USER, (user.chat_id,))
+            return cursor.rowcount
+        return self.run(work)
     
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def write_users(self, users, deleted_chat_ids):
+        '''
+        Remove the users with the given chat_ids and their subscriptions (as delete_users does), then insert the
+        given User objects (users already in the db are left as is), in one transaction.
+        Returns (number of inserted users, number of removed users).
+        '''
+        deleted_chat_ids = list(deleted_chat_ids)
+        rows = [(user.chat_id, user.first_name, user.username) for user in users]
+        def work(cursor):
+            deleted_count = 0
+            if deleted_chat_ids:
+                cursor.execute(queries.DELETE_USERS_SUBSCRIPTIONS, (deleted_chat_ids, ))
+                cursor.execute(queries.DELETE_USERS, (deleted_chat_ids, ))
+                deleted_count = cursor.rowcount
+            inserted = []
+            if rows:
+                inserted = psycopg2.extras.execute_values(cursor, queries.INSERT_USERS, rows, page_size=1000, fetch=True)
+            return len(inserted), deleted_count
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def delete_users(self, chat_ids):
+        '''
+        Remove the users with the given chat_ids and their subscriptions, in one transaction.
+        Returns the number of removed users.
+        '''
+        if not chat_ids:
+            return 0
+        chat_ids = list(chat_ids)
+        def work(cursor):
+            cursor.execute(queries.DELETE_USERS_SUBSCRIPTIONS, (chat_ids, ))
+            cursor.execute(queries.DELETE_USERS, (chat_ids, ))
+            return cursor.rowcount
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_subscriptions(self):
+        '''
+        Returns all the subscriptions as a list of (chat_id, kind, token) tuples.
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_SUBSCRIPTIONS)
+            return cursor.fetchall()
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_user_subscriptions(self, chat_id):
+        '''
+        Returns the subscriptions of a user as a list of (kind, token) tuples.
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_USER_SUBSCRIPTIONS, (chat_id, ))
+            return cursor.fetchall()
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def add_subscription(self, chat_id, kind, token):
+        '''
+        Subscribe a user to a genre or language. If the subscription already exists, do nothing.
+        Returns 1 if the subscription is added, 0 if it already exists.
+        '''
+        def work(cursor):
+            cursor.execute(queries.INSERT_SUBSCRIPTION, (chat_id, kind, token))
+            return cursor.rowcount
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def remove_subscription(self, chat_id, kind, token):
+        '''
+        Unsubscribe a user from a genre or language.
+        Returns 1 if the subscription is removed, 0 if it does not exist.
+        '''
+        def work(cursor):
+            cursor.execute(queries.DELETE_SUBSCRIPTION, (chat_id, kind, token))
+            return cursor.rowcount
+        return self.run(work)
+    
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
     def upsert_movie(self, movie):
         '''
-        Insert or update a movie object into the movies table
+        Insert or update a movie object into the movies table, released in the default region
         '''
         self.__encode_movie(movie)
-        self.cursor.execute(queries.CHECK_MOVIE_EXISTS, (movie.imdb_id,))
-        if self.cursor.fetchone(): # Movie exists, update values instead
-            self.cursor.execute(queries.UPDATE_MOVIE, (
-                        movie.title, movie.year, movie.imdb_link, movie.release_date, movie.run_time, movie.genre, 
-                        movie.director, movie.writer, movie.actors, movie.plot, movie.language, movie.country, 
-                        movie.poster_link, movie.imdb_id
-            ))
-        else: # Movie does not exists, insert into table
-            self.cursor.execute(queries.INSERT_MOVIE, (
-                        movie.imdb_id, movie.title, movie.year, movie.imdb_link, movie.release_date, movie.run_time, movie.genre, 
-                        movie.director, movie.writer, movie.actors, movie.plot, movie.language, movie.country, movie.poster_link
-            ))
-        
-        self.connection.commit()
+        def work(cursor):
+            cursor.execute(queries.CHECK_MOVIE_EXISTS, (movie.imdb_id,))
+            if cursor.fetchone(): # Movie exists, update values instead
+                cursor.execute(queries.UPDATE_MOVIE, (
+                            movie.title, movie.year, movie.imdb_link, movie.release_date, movie.run_time, movie.genre, 
+                            movie.director, movie.writer, movie.actors, movie.plot, movie.language, movie.country, 
+                            movie.poster_link, movie.imdb_id
+                ))
+            else: # Movie does not exists, insert into table
+                cursor.execute(queries.INSERT_MOVIE, (
+                            movie.imdb_id, movie.title, movie.year, movie.imdb_link, movie.release_date, movie.run_time, movie.genre, 
+                            movie.director, movie.writer, movie.actors, movie.plot, movie.language, movie.country, movie.poster_link
+                ))
+            psycopg2.extras.execute_values(cursor, queries.UPSERT_MOVIE_RELEASES,
+                                            [(movie.imdb_id, self.default_region, movie.release_date)])
+            self.__bump_catalog_version(cursor)
+        self.run(work)
+        self.invalidate_catalog()
     
-    def get_movies(self):
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def sync_movies(self, movies_by_region, today):
         '''
-        Returns movies in the database as a list of Movie objects
+        Bulk insert or update the given movie objects and their release dates in each region, then delete
+        the releases before today and the movies that are no longer released anywhere,
+        all in a single transaction, so that readers never see a partially updated movies table.
+        Returns the number of deleted (expired) movies.
+
+        @param movies_by_region: Dict of region -> list of Movie objects released there (with the release date there).
+                                 A movie released in several regions is stored once, with its earliest release date.
         '''
-        self.cursor.execute(queries.GET_MOVIES)
-        movies = [Movie(row[1], row[2], row[3], row[0], row[4], row[5], row[6], row[7], row[8], row[9], row[10], 
-                        row[11], row[12], row[13]) for row in self.cursor.fetchall()]
-        return movies
+        # Keep one row per imdb_id, a multi-row upsert cannot touch the same row twice
+        unique_movies = {}
+        release_dates = {} # imdb_id -> earliest release date across regions
+        release_rows = {} # (imdb_id, region) -> release date
+        for region, movies in movies_by_region.items():
+            for movie in movies:
+                self.__encode_movie(movie)
+                unique_movies.setdefault(movie.imdb_id, movie)
+                release_dates[movie.imdb_id] = min(release_dates.get(movie.imdb_id, movie.release_date), movie.release_date)
+                release_rows[(movie.imdb_id, region)] = movie.release_date
+        rows = [(movie.imdb_id, movie.title, movie.year, movie.imdb_link, release_dates[movie.imdb_id], movie.run_time,
+                movie.genre, movie.director, movie.writer, movie.actors, movie.plot, movie.language, movie.country,
+                movie.poster_link, movie.poster_ok) for movie in unique_movies.values()]
+        release_rows = [(imdb_id, region, release_date) for (imdb_id, region), release_date in release_rows.items()]
+
+        def work(cursor):
+            if rows:
+                psycopg2.extras.execute_values(cursor, queries.UPSERT_MOVIES, rows, page_size=500)
+                psycopg2.extras.execute_values(cursor, queries.UPSERT_MOVIE_RELEASES, release_rows, page_size=1000)
+            cursor.execute(queries.DELETE_MOVIE_RELEASES_BEFORE, (today, ))
+            cursor.execute(queries.DELETE_MOVIES_WITHOUT_RELEASES)
+            row_count = cursor.rowcount
+            return row_count, self.__bump_catalog_version(cursor)
+        row_count, version = self.run(work)
+
+        # Swap in catalogs of the committed movies
+        new_catalogs = {region: MovieCatalog(self.__load_movies(region)) for region in self.regions}
+        with self.catalog_lock:
+            self.catalogs = new_catalogs
+            self.catalog_version = version
+        return row_count
+
+    def get_catalog(self, region=None):
+        '''
+        Returns the in-memory MovieCatalog of the movies released in a region (the default region if None),
+        loading it from the db on first use.
+        '''
+        region = region or self.default_region
+        catalog = self.catalogs.get(region)
+        if catalog is None:
+            with self.catalog_lock:
+                catalog = self.catalogs.get(region)
+                if catalog is None:
+                    catalog = MovieCatalog(self.__load_movies(region))
+                    # Replace the dict rather than updating it, readers do not take the lock
+                    catalogs = dict(self.catalogs)
+                    catalogs[region] = catalog
+                    self.catalogs = catalogs
+        return catalog
+
+    def invalidate_catalog(self):
+        '''
+        Drop the in-memory catalogs so that the next read reloads them from the db.
+        '''
+        self.catalogs = {}
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def refresh_catalogs(self):
+        '''
+        Drop the in-memory catalogs if the movies were changed since they were loaded, by this instance or by
+        another instance sharing the db (e.g. the one that ran the daily update). Costs one single-row query.
+        Returns True if the catalogs were dropped.
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_SYNC_STATE_VALUE, (CATALOG_VERSION_KEY, ))
+            return cursor.fetchone()
+        row = self.run(work)
+        version = row[0] if row else None
+        with self.catalog_lock:
+            if version == self.catalog_version:
+                return False
+            self.catalogs = {}
+            self.catalog_version = version
+        return True
+
+    def get_movies(self, region=None):
+        '''
+        Returns movies released in a region (the default region if None) as a list of Movie objects,
+        sorted by release date. Served from the in-memory catalog.
+        '''
+        return list(self.get_catalog(region).movies)
     
-    def get_movies_by_title(self, title):
+    def get_movies_by_title(self, title, region=None):
+        '''
+        Returns movies released in a region that matches the given title as a list of Movie objects.
+        Title is case-insensitive. Served from the in-memory catalog.
+        '''
+        return self.get_catalog(region).get_movies_by_title(title)
+
+    def search_movies(self, query, limit=5, region=None):
+        '''
+        Returns up to "limit" movies released in a region whose title matches the query (prefix or typo-tolerant),
+        best match first, as a list of (score, Movie) tuples. Served from the in-memory catalog.
+        '''
+        return self.get_catalog(region).search_movies(query, limit)
+
+    def get_movies_released_on(self, date, region=None):
+        '''
+        Returns the movies released in a region on the given date as a list of Movie objects.
+        '''
+        return self.get_movies_released_between(date, date, region)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_movies_released_between(self, start_date, end_date, region=None):
+        '''
+        Returns the movies released in a region (the default region if None) between the two dates (both included)
+        as a list of Movie objects, sorted by release date.
+        Served from the in-memory catalog if it is loaded, else by an indexed query.
         '''
-        Returns movies in the database that matches the given title as a list of Movie objects.
-        Title is case-insensitive.
+        region = region or self.default_region
+        catalog = self.catalogs.get(region)
+        if catalog is not None:
+            return catalog.get_movies_released_between(start_date, end_date)
+        return self.__query_movie_summaries(queries.GET_MOVIE_SUMMARIES_RELEASED_BETWEEN, (region, start_date, end_date))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_movies_released_before(self, date, region=None):
+        '''
+        Returns the movies released in a region (the default region if None) before the given date
+        as a list of Movie objects, sorted by release date.
+        Served from the in-memory catalog if it is loaded, else by an indexed query.
+        '''
+        region = region or self.default_region
+        catalog = self.catalogs.get(region)
+        if catalog is not None:
+            return catalog.get_movies_released_before(date)
+        return self.__query_movie_summaries(queries.GET_MOVIE_SUMMARIES_RELEASED_BEFORE, (region, date))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query', 'load_movies')
+    def __load_movies(self, region):
+        '''
+        Returns all movies released in a region as a list of Movie summaries, with their release date there.
+        Their details (plot, actors...) are loaded from the db when first accessed.
         '''
-        self.cursor.execute(queries.GET_MOVIES_BY_TITLE, (title, ))
-        movies = [Movie(row[1], row[2], row[3], row[0], row[4], row[5], row[6], row[7], row[8], row[9], row[10], 
-                        row[11], row[12], row[13]) for row in self.cursor.fetchall()]
+        return self.__query_movie_summaries(queries.GET_MOVIE_SUMMARIES, (region, ))
+
+    def __query_movie_summaries(self, query, params=None):
+        '''
+        Runs a query selecting the summary columns of movies and returns them as a list of Movie summaries.
+        '''
+        def work(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        movies = [Movie.summary(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], self.__load_movie_details)
+                    for row in self.run(work)]
         return movies
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def load_movie_details(self, movies):
+        '''
+        Load the details (see movie.DETAIL_FIELDS) of the given Movie summaries in one query.
+        Movies that are no longer in the db get empty details.
+        '''
+        movies = [movie for movie in movies if not movie.has_details()]
+        if not movies:
+            return
+        imdb_ids = [movie.imdb_id for movie in movies]
+        def work(cursor):
+            cursor.execute(queries.GET_MOVIE_DETAILS, (imdb_ids, ))
+            return cursor.fetchall()
+        details = {row[0]: row[1:] for row in self.run(work)}
+        for movie in movies:
+            for field, value in zip(DETAIL_FIELDS, details.get(movie.imdb_id, ('', ) * len(DETAIL_FIELDS))):
+                setattr(movie, field, value)
+
+    def __load_movie_details(self, movie):
+        self.load_movie_details([movie])
     
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def set_poster_file_id(self, movie, file_id):
+        '''
+        Store the Telegram file_id of a movie's poster so that it can be sent again without downloading it.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.UPDATE_MOVIE_POSTER_FILE_ID, (file_id, movie.imdb_id)))
+        movie.poster_file_id = file_id
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def set_poster_not_ok(self, movie):
+        '''
+        Mark the poster of a movie as not usable, so that its details are sent without it.
+        The poster link is checked again by the next update.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.UPDATE_MOVIE_POSTER_NOT_OK, (movie.imdb_id, )))
+        movie.poster_ok = False
+        movie.poster_file_id = None
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
     def delete_movie(self, movie):
         '''
         Delete a movie object from the movies table.
         Returns 1 if the movie is removed, 0 if the movie does not exists in the db.
         '''
-        self.cursor.execute(queries.DELETE_MOVIE, (movie.imdb_id,))
-        row_count = self.cursor.rowcount
-        self.connection.commit()
+        def work(cursor):
+            cursor.execute(queries.DELETE_MOVIE_RELEASES, (movie.imdb_id,))
+            cursor.execute(queries.DELETE_MOVIE, (movie.imdb_id,))
+            row_count = cursor.rowcount
+            self.__bump_catalog_version(cursor)
+            return row_count
+        row_count = self.run(work)
+        self.invalidate_catalog()
         return row_count
 
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_omdb_cache(self, imdb_ids):
+        '''
+        Returns the cached OMDb responses of the given imdb_ids as a dict of
+        imdb_id -> (details dict, expiry datetime). Expired entries are included.
+        '''
+        imdb_ids = list(imdb_ids)
+        def work(cursor):
+            cursor.execute(queries.GET_OMDB_CACHE, (imdb_ids, ))
+            return cursor.fetchall()
+        return {row[0]: (json.loads(row[1]), row[2]) for row in self.run(work)}
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def store_omdb_cache(self, entries):
+        '''
+        Insert or replace cached OMDb responses.
+
+        @param entries: List of (imdb_id, details dict, expiry datetime) tuples.
+        '''
+        if not entries:
+            return
+        rows = [(imdb_id, json.dumps(details), expires_at) for imdb_id, details, expires_at in entries]
+        self.run(lambda cursor: psycopg2.extras.execute_values(cursor, queries.UPSERT_OMDB_CACHE, rows))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def evict_omdb_cache(self, imdb_ids):
+        '''
+        Remove cached OMDb responses of all titles except the given imdb_ids.
+        Returns the number of evicted entries.
+        '''
+        imdb_ids = list(imdb_ids)
+        def work(cursor):
+            cursor.execute(queries.EVICT_OMDB_CACHE, (imdb_ids, ))
+            return cursor.rowcount
+        return self.run(work)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def claim_job_run(self, job_name, run_key, owner, lease_seconds):
+        '''
+        Claim the lease of a job run for the given owner, unless the run is completed or its lease is held.
+        Returns True if claimed.
+        '''
+        def work(cursor):
+            cursor.execute(queries.CLAIM_JOB_RUN, (job_name, run_key, owner, lease_seconds))
+            return cursor.fetchone()
+        return self.run(work) is not None
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_job_run(self, job_name, run_key):
+        '''
+        Returns (completed, seconds left on the lease) of a job run, or (False, 0) if it was never claimed.
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_JOB_RUN, (job_name, run_key))
+            return cursor.fetchone()
+        row = self.run(work)
+        return (row[0], float(row[1])) if row else (False, 0)
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def renew_job_run(self, job_name, run_key, owner, lease_seconds):
+        '''
+        Extend the lease of a job run held by the given owner. Returns True if the owner still held it.
+        '''
+        def work(cursor):
+            cursor.execute(queries.RENEW_JOB_RUN, (lease_seconds, job_name, run_key, owner))
+            return cursor.rowcount
+        return self.run(work) == 1
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def finish_job_run(self, job_name, run_key, owner, completed):
+        '''
+        Release the lease of a job run held by the given owner. If completed is False, the run can be claimed again.
+        '''
+        self.run(lambda cursor: cursor.execute(queries.FINISH_JOB_RUN, (completed, job_name, run_key, owner)))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def get_sync_state(self):
+        '''
+        Returns the sync state as a dict of key -> value (str).
+        '''
+        def work(cursor):
+            cursor.execute(queries.GET_SYNC_STATE)
+            return cursor.fetchall()
+        return dict(self.run(work))
+
+    @metrics.timed(metrics.DB_QUERY_SECONDS, 'query')
+    def set_sync_state(self, values):
+        '''
+        Insert or replace sync state values, all in a single transaction.
+
+        @param values: Dict of key -> value (str or None).
+        '''
+        if not values:
+            return
+        rows = list(values.items())
+        self.run(lambda cursor: psycopg2.extras.execute_values(cursor, queries.UPSERT_SYNC_STATE, rows))
+
+    def __bump_catalog_version(self, cursor):
+        '''
+        Store a new catalog version in the transaction of a write to the movies, so that other instances
+        reload their catalogs (see refresh_catalogs). Returns the new version.
+        '''
+        version = uuid.uuid4().hex
+        psycopg2.extras.execute_values(cursor, queries.UPSERT_SYNC_STATE, [(CATALOG_VERSION_KEY, version)])
+        return version
+
     def __encode_movie(self, movie):
         '''
         Encode a movie object by taking Unicode data and represent it in ASCII characters
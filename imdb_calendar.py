@@ -0,0 +1,85 @@
+"""
+Incremental parser for the IMDB release calendar page
+"""
+
+from html.parser import HTMLParser
+
+class ImdbCalendarParser(HTMLParser):
+    '''
+    Parses the IMDB calendar page as it is fed in chunks, without building a document tree.
+    Only the date headers (h4) inside the #main element and the list items of the list that follows
+    each header are looked at. Every list item found is appended to "entries" as a
+    (date text, item text, first link href) tuple, to be drained by the caller between feeds.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.entries = [] # Parsed (date text, item text, href) tuples not yet drained by the caller
+        self.main_tag = None # Tag name of the #main element, once found
+        self.main_depth = 0 # Nesting depth of main_tag inside the #main element (0 if outside)
+        self.in_h4 = False
+        self.h4_text = []
+        self.release_date = None # Text of the last date header
+        self.waiting_for_ul = False # True between a date header and the list that follows it
+        self.ul_depth = 0 # Nesting depth of ul inside the current release list (0 if outside)
+        self.li_depth = 0 # Nesting depth of li inside the current list item (0 if outside)
+        self.li_text = []
+        self.li_href = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.main_tag is None:
+            if dict(attrs).get('id') == 'main':
+                self.main_tag = tag
+                self.main_depth = 1
+            return
+
+        if tag == self.main_tag and self.main_depth:
+            self.main_depth += 1
+
+        if tag == 'h4' and self.main_depth and not self.ul_depth:
+            self.in_h4 = True
+            self.h4_text = []
+        elif tag == 'ul' and (self.waiting_for_ul or self.ul_depth):
+            self.waiting_for_ul = False
+            self.ul_depth += 1
+        elif tag == 'li' and self.ul_depth:
+            if not self.li_depth:
+                self.li_text = []
+                self.li_href = None
+            self.li_depth += 1
+        elif tag == 'a' and self.li_depth and self.li_href is None:
+            self.li_href = dict(attrs).get('href')
+
+    def handle_endtag(self, tag):
+        if tag == 'h4' and self.in_h4:
+            self.in_h4 = False
+            self.release_date = ''.join(self.h4_text)
+            self.waiting_for_ul = True
+        elif tag == 'li' and self.li_depth:
+            self.li_depth -= 1
+            if not self.li_depth:
+                self.entries.append((self.release_date, ''.join(self.li_text), self.li_href))
+        elif tag == 'ul' and self.ul_depth:
+            self.ul_depth -= 1
+        elif tag == self.main_tag and self.main_depth:
+            self.main_depth -= 1
+
+    def handle_data(self, data):
+        if self.in_h4:
+            self.h4_text.append(data)
+        if self.li_depth:
+            self.li_text.append(data)
+def soup_calendar_entries(page):
+    '''
+    Returns the (date text, item text, first link href) tuples of a whole IMDB calendar page, parsed with a
+    full BeautifulSoup tree. Slower than ImdbCalendarParser, used when IMDB_PARSER is set to "soup".
+    '''
+    # bs4 is only imported by this parser, it is slow to import
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, 'html.parser')
+    main_div = soup.find(id='main')
+    entries = []
+    for release_date_element in main_div.find_all('h4'):
+        for title_element in release_date_element.find_next('ul').find_all('li'):
+            entries.append((release_date_element.text, title_element.text, title_element.a['href']))
+    return entries
@@ -0,0 +1,76 @@
+"""
+Runs each scheduled job once across every running instance of the bot
+"""
+
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+
+LOGGER = logging.getLogger()
+
+class JobLeases:
+    '''
+    Elects which instance runs a scheduled job using leases stored in the job_runs table.
+    Every instance schedules the same jobs. When a job is due, each instance tries to claim the
+    (job name, run key) lease; only the one that succeeds runs the job, renewing the lease while it runs.
+    The others check again once the lease expires, so the job is taken over if its runner dies midway.
+    '''
+
+    def __init__(self, db_mgr, timezone, lease_seconds=None):
+        self.db_mgr = db_mgr
+        self.timezone = timezone # Timezone of the run keys (the date a daily job is due)
+        self.lease_seconds = lease_seconds or int(os.getenv('JOB_LEASE_SECONDS', 120))
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8]) # This instance
+
+    def daily_job(self, job_name, callback):
+        '''
+        Returns a job callback running callback(context) at most once per day across all instances.
+        The run fails if the callback raises or returns False, and is then retried by another instance.
+        '''
+        def job(context):
+            # A retry of the job carries the run key of the day it was due
+            run_key = context.job.context or datetime.datetime.now(self.timezone).date().isoformat()
+            self.run(job_name, run_key, callback, context, job)
+        return job
+
+    def run(self, job_name, run_key, callback, context, job):
+        '''
+        Runs callback(context) if this instance claims the lease of the run, else schedule a check
+        for when the current lease expires.
+        '''
+        if not self.db_mgr.claim_job_run(job_name, run_key, self.owner, self.lease_seconds):
+            completed, seconds_left = self.db_mgr.get_job_run(job_name, run_key)
+            if not completed:
+                LOGGER.info("Job {} ({}) is run by another instance, checking again in {:.0f}s"
+                            .format(job_name, run_key, seconds_left))
+                context.job_queue.run_once(job, max(seconds_left, 0) + 1, context=run_key)
+            return
+
+        LOGGER.info("Running job {} ({}) as {}".format(job_name, run_key, self.owner))
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self.__heartbeat, args=(job_name, run_key, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        completed = False
+        try:
+            completed = callback(context) is not False
+            if not completed:
+                LOGGER.warning("Job {} ({}) failed, releasing its lease".format(job_name, run_key))
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            # A failed run releases its lease so that an instance still waiting for it can retry it
+            self.db_mgr.finish_job_run(job_name, run_key, self.owner, completed)
+
+    def __heartbeat(self, job_name, run_key, stop_heartbeat):
+        '''
+        Renew the lease of the run regularly until stop_heartbeat is set.
+        '''
+        while not stop_heartbeat.wait(self.lease_seconds / 3):
+            try:
+                if not self.db_mgr.renew_job_run(job_name, run_key, self.owner, self.lease_seconds):
+                    LOGGER.warning("Lost the lease of job {} ({})".format(job_name, run_key))
+            except Exception:
+                LOGGER.exception("Failed to renew the lease of job {} ({})".format(job_name, run_key))
\ No newline at end of file
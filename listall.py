@@ -0,0 +1,41 @@
+"""
+Renders the /listall message into pages that fit in a Telegram message
+"""
+
+LISTALL_PAGE_LENGTH = 3500 # Max characters per /listall page (Telegram's limit is 4096)
+
+def render_listall_pages(movies, region_name='Singapore', max_page_length=LISTALL_PAGE_LENGTH):
+    '''
+    Renders the /listall message of the given movies (sorted by release date) into pages
+    of at most max_page_length characters each. Returns the list of pages.
+    A page starting in the middle of the movies of a date repeats the date first.
+    '''
+    header = "Here are the upcoming movie releases in {}. To view a movie's information, " \
+            "type /info followed by the name of the movie.".format(region_name)
+
+    pages = []
+    page_lines = [header]
+    page_length = len(header)
+
+    def add_line(line):
+        nonlocal page_length
+        page_lines.append(line)
+        page_length += len(line) + 1
+
+    prev_date = None
+    for movie in movies:
+        date_line = movie.release_date.strftime("<b>%d %B %Y</b>")
+        movie_line = "🎬 " + movie.title
+        # A new date starts with its heading, kept on the same page as its first movie
+        new_lines = [movie_line] if movie.release_date == prev_date else ["\n" + date_line, movie_line]
+        prev_date = movie.release_date
+        if page_length + sum(len(line) + 1 for line in new_lines) > max_page_length and len(page_lines) > 1:
+            pages.append("\n".join(page_lines))
+            page_lines = []
+            page_length = 0
+            if len(new_lines) == 1:
+                add_line(date_line + " (continued)")
+        for line in new_lines:
+            add_line(line)
+    pages.append("\n".join(page_lines))
+    return pages
@@ -0,0 +1,325 @@
+"""
+Load test of the webhook: how many updates per second the bot handles, and how long updates wait.
+
+Synthetic Telegram updates (/start, /listall, /info <title> and bursts of /stop) are posted to the webhook
+started by updater.start_webhook, at several levels of concurrency. The Telegram Bot API, IMDB and OMDb are
+replaced by the fake server of benchmark.py, and the bot's tables are created in a local PostgreSQL database
+given by the BENCH_DB_NAME, BENCH_DB_HOST, BENCH_DB_PORT and BENCH_DB_USER environment variables. The tables
+of that database are emptied by the load test, so never point it to a database that is in use.
+
+For each level, reports the throughput and the p50/p95/p99 of:
+    - webhook: duration of the POST to the webhook (until the update is queued)
+    - queue: delay between the POST and the start of the handler
+    - handler: duration of the handler
+    - total: delay between the POST and the end of the handler
+
+Usage:
+    python3 loadtest.py [--concurrency 1 8 32] [--updates 2000] [--rate 0] [--workers 4] [--titles 1000]
+                        [--output loadtest.json]
+"""
+
+from benchmark import FakeUpstreams
+from benchmark import TOKEN
+from benchmark import TRUNCATE_TABLES
+from concurrent.futures import ThreadPoolExecutor
+from database import DatabaseManager
+from refresh import RefreshCoordinator
+from subscriber_buffer import SubscriberBuffer
+from telegram import Bot
+from telegram.ext import Updater
+import argparse
+import collections
+import json
+import logging
+import main
+import math
+import metrics
+import os
+import random
+import requests
+import socket
+import sys
+import threading
+import time
+
+CHAT_ID_STEP = 50 # Synthetic chat_ids are 1, 51, 101... none of them is blocked by the fake Bot API
+FAILED_POST = 'failed_post' # Handler name recorded for the updates that could not be posted
+
+class LatencyStats:
+    '''
+    Timestamps of every update posted to the webhook and of its handler, by update_id.
+    '''
+
+    def __init__(self, expected):
+        self.expected = expected # Number of updates to be handled
+        self.posts = {} # update_id -> (command, time the POST started, POST duration)
+        self.handled = [] # (update_id, handler name, handler start time, handler end time, error)
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def record_post(self, update_id, command, started, duration):
+        with self.lock:
+            self.posts[update_id] = (command, started, duration)
+
+    def record_handler(self, update_id, handler_name, started, ended, error):
+        with self.lock:
+            self.handled.append((update_id, handler_name, started, ended, error))
+            if len(self.handled) >= self.expected:
+                self.finished.set()
+
+def percentile(values, p):
+    '''
+    Returns the p-th percentile (nearest rank) of the values, or None if there are none.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(values):
+    '''
+    Returns the p50/p95/p99 (in milliseconds) and the count of a list of durations in seconds.
+    '''
+    summary = {'count': len(values)}
+    for p in (50, 95, 99):
+        value = percentile(values, p)
+        summary['p{}_ms'.format(p)] = round(value * 1000, 2) if value is not None else None
+    return summary
+
+def synthetic_update(update_id, chat_id, text):
+    '''
+    Returns the JSON of a Telegram update with a text message from a private chat.
+    '''
+    command = text.split(' ', 1)[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'User{}'.format(chat_id)},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User{}'.format(chat_id),
+                    'username': 'user{}'.format(chat_id)},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        }
+    }
+
+def synthetic_updates(count, chats, titles, mix, stop_burst, first_update_id):
+    '''
+    Returns a list of (update_id, command, update JSON) following the given mix of commands.
+    A "stop" pick is a burst of stop_burst /stop updates from consecutive chats.
+
+    @param mix: Dict of command ('start', 'listall', 'info' or 'stop') -> weight.
+    '''
+    commands, weights = zip(*mix.items())
+    updates = []
+    update_id = first_update_id
+    while len(updates) < count:
+        command = random.choices(commands, weights)[0]
+        first_chat = random.randrange(chats)
+        for i in range(stop_burst if command == 'stop' else 1):
+            chat_id = ((first_chat + i) % chats) * CHAT_ID_STEP + 1
+            if command == 'info':
+                text = '/info Synthetic Movie {}'.format(random.randrange(titles))
+            else:
+                text = '/' + command
+            updates.append((update_id, command, synthetic_update(update_id, chat_id, text)))
+            update_id += 1
+    return updates[:count]
+
+def instrument_handlers(dispatcher, get_stats):
+    '''
+    Wrap the callback of every handler of the dispatcher to record when it starts and ends in get_stats().
+    '''
+    def wrap(callback):
+        def wrapper(update, context):
+            started = time.perf_counter()
+            error = True
+            try:
+                result = callback(update, context)
+                error = False
+                return result
+            finally:
+                get_stats().record_handler(update.update_id, callback.__name__, started, time.perf_counter(), error)
+        return wrapper
+
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = wrap(handler.callback)
+
+def post_updates(webhook_url, updates, concurrency, rate, stats):
+    '''
+    Post the updates to the webhook from "concurrency" threads, each waiting for the answer of its previous POST.
+    If rate is set, the updates are also spaced to send at most "rate" updates per second in total.
+    A failed POST is recorded as a failed handler, as the update never reaches the bot.
+    '''
+    local = threading.local()
+    start_time = time.perf_counter()
+
+    def post(index):
+        update_id, command, update = updates[index]
+        if rate:
+            delay = start_time + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = local.session.post(webhook_url, json=update, timeout=30)
+            response.raise_for_status()
+        except requests.RequestException:
+            stats.record_handler(update_id, FAILED_POST, started, started, True)
+            return
+        stats.record_post(update_id, command, started, time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(post, range(len(updates))))
+
+def run_level(webhook_url, updates, concurrency, rate, timeout, stats):
+    '''
+    Posts the updates at one level of concurrency, waits for their handlers and returns the report.
+    '''
+    start_time = time.perf_counter()
+    post_updates(webhook_url, updates, concurrency, rate, stats)
+    all_handled = stats.finished.wait(timeout)
+    with stats.lock:
+        posts = dict(stats.posts)
+        handled = list(stats.handled)
+    end_time = max([ended for _, _, _, ended, _ in handled] or [time.perf_counter()])
+    elapsed = end_time - start_time
+    failed_posts = sum(1 for _, handler_name, _, _, _ in handled if handler_name == FAILED_POST)
+    handled_count = len(handled) - failed_posts
+
+    by_command = collections.defaultdict(lambda: collections.defaultdict(list))
+    for update_id, _, started, ended, error in handled:
+        if update_id not in posts:
+            continue
+        command, posted, post_duration = posts[update_id]
+        for key in (command, 'all'):
+            by_command[key]['webhook'].append(post_duration)
+            by_command[key]['queue'].append(started - posted)
+            by_command[key]['handler'].append(ended - started)
+            by_command[key]['total'].append(ended - posted)
+            by_command[key]['errors'].append(error)
+
+    report = {
+        'concurrency': concurrency,
+        'updates': len(updates),
+        'handled': handled_count,
+        'failed_posts': failed_posts,
+        'timed_out': not all_handled,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(handled_count / elapsed, 1) if elapsed else None,
+        'latency': {
+            command: dict({name: summarize(values[name]) for name in ('webhook', 'queue', 'handler', 'total')},
+                            errors=sum(values['errors']))
+            for command, values in sorted(by_command.items())
+        }
+    }
+    latency = report['latency'].get('all', {})
+    print("concurrency={}: {} updates/s, total p50/p95/p99 = {}/{}/{} ms, queue p99 = {} ms".format(
+            concurrency, report['throughput_per_s'],
+            latency.get('total', {}).get('p50_ms'), latency.get('total', {}).get('p95_ms'),
+            latency.get('total', {}).get('p99_ms'), latency.get('queue', {}).get('p99_ms')))
+    return report
+
+def parse_mix(text):
+    '''
+    Parses a mix of commands such as "start=1,listall=3,info=5,stop=1" into a dict of command -> weight.
+    '''
+    mix = {}
+    for part in text.split(','):
+        command, _, weight = part.partition('=')
+        if command not in ('start', 'listall', 'info', 'stop'):
+            raise argparse.ArgumentTypeError("Unknown command in mix: {}".format(command))
+        mix[command] = float(weight or 1)
+    return mix
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the webhook with synthetic updates.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='Concurrent webhook POSTs')
+    parser.add_argument('--updates', type=int, default=2000, help='Updates posted at each level of concurrency')
+    parser.add_argument('--rate', type=float, default=0, help='Max updates posted per second (0 for no limit)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('start=2,listall=3,info=4,stop=1'),
+                        help='Weights of the commands, e.g. start=2,listall=3,info=4,stop=1')
+    parser.add_argument('--stop-burst', type=int, default=20, help='Number of /stop updates sent in a burst')
+    parser.add_argument('--chats', type=int, default=1000, help='Number of distinct synthetic chats')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WORKERS', 4)), help='Workers of the Updater')
+    parser.add_argument('--titles', type=int, default=1000, help='Movies on the fake IMDB calendar')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for the handlers of a level')
+    parser.add_argument('--output', help='File to save the reports to (JSON)')
+    return parser.parse_args()
+
+def main_loadtest():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    upstreams = FakeUpstreams(args.titles, omdb_latency=0, telegram_rate=10 ** 9).start()
+    os.environ['IMDB_CALENDAR_URL'] = upstreams.url + '/calendar/'
+    os.environ['OMDB_API_URL'] = upstreams.url + '/omdb/'
+    os.environ.setdefault('OMDB_API_KEY', 'benchmark')
+    os.environ['OMDB_DAILY_LIMIT'] = str(10 ** 9) # Every title is looked up, the fake OMDb has no quota
+
+    db_mgr = DatabaseManager(os.getenv('BENCH_DB_NAME'), os.getenv('BENCH_DB_USER'), os.getenv('BENCH_DB_PORT'),
+                            os.getenv('BENCH_DB_HOST'), password=os.getenv('BENCH_DB_PASSWORD', ''))
+    if not db_mgr.connect_db(with_pwd=bool(db_mgr.password)):
+        sys.exit(1)
+    db_mgr.create_tables()
+    db_mgr.run(lambda cursor: cursor.execute(TRUNCATE_TABLES))
+    db_mgr.invalidate_catalog()
+    main.DB_MGR = db_mgr
+    main.REFRESHER = RefreshCoordinator(main.refresh_db, 0)
+    main.SUBSCRIBERS = SubscriberBuffer(db_mgr).start()
+    print("Loading {} movies from the fake calendar...".format(args.titles))
+    main.update_db(None)
+
+    # The bot as started by main(), with the Bot API calls sent to the fake server
+    bot = Bot(TOKEN, base_url=upstreams.url + '/bot', request=metrics.InstrumentedRequest(con_pool_size=args.workers + 4))
+    updater = Updater(bot=bot, use_context=True, workers=args.workers)
+    main.add_handlers(updater.dispatcher)
+    current_stats = [None]
+    instrument_handlers(updater.dispatcher, lambda: current_stats[0])
+    port = free_port()
+    updater.start_webhook(listen='127.0.0.1', port=port, url_path=TOKEN)
+    if not wait_for_port(port):
+        print("The webhook did not start")
+        sys.exit(1)
+    webhook_url = 'http://127.0.0.1:{}/{}'.format(port, TOKEN)
+
+    reports = []
+    try:
+        next_update_id = 1
+        for concurrency in args.concurrency:
+            updates = synthetic_updates(args.updates, args.chats, args.titles, args.mix, args.stop_burst, next_update_id)
+            next_update_id += len(updates)
+            current_stats[0] = LatencyStats(len(updates))
+            reports.append(run_level(webhook_url, updates, concurrency, args.rate, args.timeout, current_stats[0]))
+    finally:
+        updater.stop()
+        main.SUBSCRIBERS.close()
+        upstreams.stop()
+
+    print(json.dumps(reports, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2)
+        print("Saved the reports to {}".format(args.output))
+
+if __name__ == '__main__':
+    main_loadtest()
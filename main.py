@@ -4,20 +4,36 @@ A telegram bot that notifies users of movie releases in Singapore.
 Author: Yap Ni
 """
 
+from broadcast import Broadcaster
+from concurrent.futures import ThreadPoolExecutor
 from database import DatabaseManager
+from leadership import JobLeases
+from listall import render_listall_pages
+from movie import DETAIL_FIELDS
+from refresh import RefreshCoordinator
 from releases import Releases
+from subscriber_buffer import SubscriberBuffer
+from subscriptions import SubscriptionIndex
+from telegram import Bot
+from telegram import InlineKeyboardButton
+from telegram import InlineKeyboardMarkup
 from telegram import ParseMode
-from telegram.error import Unauthorized
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext
+from telegram.ext import CallbackQueryHandler
 from telegram.ext import CommandHandler
 from telegram.ext import Updater
 from user import User
+import atexit
 import datetime
 import logging
+import metrics
 import os
+import profiling
 import pytz
-import requests
+import refresh
 import sql_queries as queries
+import subscriptions
 import sys
 import urllib
 
@@ -26,6 +42,15 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
                     level=logging.INFO)
 LOGGER = logging.getLogger()
 
+LISTALL_PAGES = {} # Region -> (MovieCatalog the pages were rendered from, list of pages)
+INFO_MAX_CHOICES = 5 # Max number of movies offered when an /info query matches several movies
+# Names of the regions (see REGIONS) used in messages, other regions are shown by their code
+REGION_NAMES = {'sg': 'Singapore', 'my': 'Malaysia', 'au': 'Australia', 'nz': 'New Zealand', 'id': 'Indonesia',
+                'ph': 'the Philippines', 'th': 'Thailand', 'hk': 'Hong Kong', 'in': 'India', 'jp': 'Japan',
+                'gb': 'the United Kingdom', 'us': 'the United States', 'ca': 'Canada'}
+ADMIN_CHAT_IDS = set() # Chats allowed to use the admin commands (see ADMIN_CHAT_IDS), set in main()
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def start(update, context):
     '''
     Callback function for /start command.
@@ -35,20 +60,22 @@ def start(update, context):
     first_name = update.effective_user.first_name
     username = update.effective_user.username
 
-    # Add new user to DB
+    # Add new user (written to the DB in the background)
     user = User(chat_id, first_name, username)
-    success_add = DB_MGR.insert_user(user)
+    success_add = SUBSCRIBERS.add(user)
 
     if success_add: # User added to db
         LOGGER.info("New user: " + str(user))
-        msg = "Welcome to @sgmovierelease_bot! This bot notifies you when a movie is released in Singapore and " \
+        msg = "Welcome to @sgmovierelease_bot! This bot notifies you when a movie is released in {} and " \
             "lets you know all upcoming movie releases! To view the list of commands, type /help.\n\n" \
-            "⚠ Note: The upcoming movie releases are curated from IMDB's website and are hence not exhaustive."
+            "⚠ Note: The upcoming movie releases are curated from IMDB's website and are hence not exhaustive." \
+            .format(region_name(user_region(chat_id)))
         context.bot.send_message(chat_id=chat_id, text=msg)
     else: # User already in db
         msg = "You have already started the bot. To view the list of commands, type /help."
         context.bot.send_message(chat_id=chat_id, text=msg)
 
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def stop(update, context):
     '''
     Callback function for /stop command.
@@ -59,7 +86,7 @@ def stop(update, context):
     username = update.effective_user.username
 
     user = User(chat_id, first_name, username)
-    success_del = DB_MGR.delete_user(user)
+    success_del = SUBSCRIBERS.remove(chat_id)
 
     if success_del: # User exists in db and successfully removed
         LOGGER.info("Removed user: " + str(user))
@@ -73,69 +100,297 @@ def stop(update, context):
                 "To receive movie release updates from the bot, type /start."
         context.bot.send_message(chat_id=chat_id, text=msg)
 
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def subscribe(update, context):
+    '''
+    Callback function for /subscribe command.
+    Type "/subscribe genre Horror" or "/subscribe language Korean" to only be notified of the movies of
+    the genres and languages you are subscribed to. Type "/subscribe" alone to see your subscriptions.
+    '''
+    chat_id = update.effective_chat.id
+    parsed = parse_subscription(context.args)
+
+    if parsed is None:
+        context.bot.send_message(chat_id=chat_id, text=subscriptions_message(chat_id), parse_mode=ParseMode.HTML)
+        return
+
+    kind, token = parsed
+    if DB_MGR.add_subscription(chat_id, kind, token):
+        msg = "✔ You will be notified of the {} movies released in {}. " \
+                "Type /subscribe to see all your subscriptions.".format(token.title(), region_name(user_region(chat_id)))
+    else:
+        msg = "You are already subscribed to the {} {}.".format(kind, token.title())
+    context.bot.send_message(chat_id=chat_id, text=msg)
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def unsubscribe(update, context):
+    '''
+    Callback function for /unsubscribe command.
+    Type "/unsubscribe genre Horror" or "/unsubscribe language Korean" to remove a subscription.
+    Once you have no subscriptions left, you are notified of every movie release again.
+    '''
+    chat_id = update.effective_chat.id
+    parsed = parse_subscription(context.args)
+
+    if parsed is None:
+        context.bot.send_message(chat_id=chat_id, text=subscriptions_message(chat_id), parse_mode=ParseMode.HTML)
+        return
+
+    kind, token = parsed
+    if DB_MGR.remove_subscription(chat_id, kind, token):
+        msg = "✔ You are no longer subscribed to the {} {}. " \
+                "Type /subscribe to see your remaining subscriptions.".format(kind, token.title())
+    else:
+        msg = "You are not subscribed to the {} {}.".format(kind, token.title())
+    context.bot.send_message(chat_id=chat_id, text=msg)
+
+def parse_subscription(args):
+    '''
+    Returns the (kind, token) of the arguments of /subscribe or /unsubscribe (e.g. ['genre', 'Sci-Fi']),
+    or None if they are missing or invalid.
+    '''
+    if not args or len(args) < 2 or args[0].lower() not in subscriptions.KINDS:
+        return None
+    token = subscriptions.normalize_token(' '.join(args[1:]))
+    if not token or len(token) > 50:
+        return None
+    return args[0].lower(), token
+
+def subscriptions_message(chat_id):
+    '''
+    Returns the message listing the subscriptions of a user and how to change them.
+    '''
+    user_subscriptions = DB_MGR.get_user_subscriptions(chat_id)
+    if user_subscriptions:
+        lines = ["↘ {} {}".format(kind.capitalize(), token.title()) for kind, token in user_subscriptions]
+        msg = "You are notified of the movies of these genres and languages only:\n" + "\n".join(lines) + "\n\n"
+    else:
+        msg = "You are notified of every movie release.\n\n"
+    return msg + "Type <b>/subscribe genre [genre]</b> or <b>/subscribe language [language]</b> " \
+                    "to only be notified of the movies of some genres or languages (e.g. /subscribe genre Horror), " \
+                    "and <b>/unsubscribe</b> followed by the same words to remove a subscription."
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def region(update, context):
+    '''
+    Callback function for /region command.
+    Type "/region my" to follow the movie releases of another region, for /listall, /info and notifications.
+    Type "/region" alone to see your region and the available regions.
+    '''
+    chat_id = update.effective_chat.id
+    new_region = context.args[0].lower() if context.args else None
+    regions_text = ", ".join("{} ({})".format(code, region_name(code)) for code in DB_MGR.regions)
+    if new_region in DB_MGR.regions and SUBSCRIBERS.is_pending(chat_id):
+        SUBSCRIBERS.flush() # Write a recent /start first, the region is stored with the user
+
+    if new_region is None:
+        msg = "You are following the movie releases in {}.\n\n" \
+                "Available regions: {}. Type /region followed by a region code to change it (e.g. /region {})." \
+                .format(region_name(user_region(chat_id)), regions_text, DB_MGR.regions[-1])
+    elif new_region not in DB_MGR.regions:
+        msg = "Sorry, we do not track the movie releases of this region ☹ Available regions: {}.".format(regions_text)
+    elif DB_MGR.set_user_region(chat_id, new_region):
+        SUBSCRIBERS.set_region(chat_id, new_region)
+        msg = "✔ You are now following the movie releases in {}.".format(region_name(new_region))
+    else:
+        msg = "To pick a region, first type /start to receive movie release updates from the bot. " \
+                "You can still list the releases of a region with /listall followed by its code (e.g. /listall {}).".format(new_region)
+    context.bot.send_message(chat_id=chat_id, text=msg)
+
+def user_region(chat_id):
+    '''
+    Returns the region of a user without querying the db: the default region if a single region is tracked,
+    if the user has not picked one or if the region picked is no longer tracked.
+    '''
+    if len(DB_MGR.regions) == 1:
+        return DB_MGR.default_region
+    region = SUBSCRIBERS.get_region(chat_id)
+    return region if region in DB_MGR.regions else DB_MGR.default_region
+
+def region_name(region):
+    '''
+    Returns the name of a region used in messages (e.g. 'Singapore' for 'sg').
+    '''
+    return REGION_NAMES.get(region, region.upper())
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def update(update, context):
     '''
     Callback function for /update command.
+    Admins (see ADMIN_CHAT_IDS) can type "/update force" to ignore the cached movie details and fetch all of them
+    again. Other users cannot, as it spends a large part of the daily OMDb quota.
+    The update runs in the background. If an update is already running, the user is notified when it finishes.
+    If the database was updated recently, nothing is done.
     '''
     chat_id = update.effective_chat.id
+    force_refresh = 'force' in (context.args or [])
+    if force_refresh and chat_id not in ADMIN_CHAT_IDS:
+        denied_msg = "Sorry, only the admins of the bot can refresh the details of every movie. " \
+                        "Type /update alone to update the database."
+        context.bot.send_message(chat_id=chat_id, text=denied_msg)
+        return
 
-    updating_msg = "⏳ Updating the database...."
-    context.bot.send_message(chat_id=chat_id, text=updating_msg)
+    def on_progress(text):
+        context.bot.send_message(chat_id=chat_id, text="⏳ " + text)
 
-    if update_db(None): # Success
-        updated_msg = "✔ Database successfully updated!"
-        context.bot.send_message(chat_id=chat_id, text=updated_msg)
+    def on_done(success):
+        if success:
+            updated_msg = "✔ Database successfully updated!"
+            context.bot.send_message(chat_id=chat_id, text=updated_msg)
+        else:
+            failed_msg = "❌ Failed to update database"
+            context.bot.send_message(chat_id=chat_id, text=failed_msg)
+
+    status = REFRESHER.request(on_progress=on_progress, on_done=on_done, force_refresh=force_refresh)
+    if status == refresh.STARTED:
+        updating_msg = "⏳ Updating the database...."
+        context.bot.send_message(chat_id=chat_id, text=updating_msg)
+    elif status == refresh.JOINED:
+        joined_msg = "⏳ The database is already being updated. You will be notified when it is done."
+        context.bot.send_message(chat_id=chat_id, text=joined_msg)
     else:
-        failed_msg = "❌ Failed to update database"
-        context.bot.send_message(chat_id=chat_id, text=failed_msg)
+        minutes_ago = int(REFRESHER.seconds_since_last_run() // 60)
+        result = "successfully updated" if REFRESHER.last_result else "last updated (unsuccessfully)"
+        recent_msg = "✔ The database was {} {} minute(s) ago. Please try again later.".format(result, minutes_ago)
+        context.bot.send_message(chat_id=chat_id, text=recent_msg)
 
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def profile(update, context):
+    '''
+    Callback function for /profile command (admins only).
+    Type "/profile on" or "/profile off" to start or stop profiling the commands and daily tasks,
+    and "/profile" alone to see whether profiling is on and the size of the profiles written so far.
+    '''
+    chat_id = update.effective_chat.id
+    if chat_id not in ADMIN_CHAT_IDS:
+        return
+    action = context.args[0].lower() if context.args else None
+
+    if action == 'on':
+        profiling.PROFILER.enable()
+    elif action == 'off':
+        profiling.PROFILER.disable()
+    enabled, file_count, total_bytes = profiling.PROFILER.status()
+    msg = "Profiling is {}. {} file(s) ({:.1f} MB) in {}.".format("on" if enabled else "off", file_count,
+                                                                    total_bytes / 1024 / 1024,
+                                                                    os.path.abspath(profiling.PROFILER.directory))
+    context.bot.send_message(chat_id=chat_id, text=msg)
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def listall(update, context):
     '''
     Callback function for /list command.
-    Lists all the movies in the db.
+    Lists all the movies released in the region of the user, one page at a time.
+    Type "/listall my" to list the movies released in another region.
     '''
     chat_id = update.effective_chat.id
+    if context.args and context.args[0].lower() in DB_MGR.regions:
+        listall_region = context.args[0].lower()
+    else:
+        listall_region = user_region(chat_id)
+    text, reply_markup = listall_page_message(0, listall_region)
+    context.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
-    # Get movies and sort by release date
-    movies = DB_MGR.get_movies()
-    movies.sort(key=lambda movie: movie.release_date)
-
-    # Craft movies list text
-    movies_list_msg = ""
-    prev_date = None
-    for movie in movies:
-        if movie.release_date != prev_date:
-            prev_date = movie.release_date
-            movies_list_msg = movies_list_msg + movie.release_date.strftime("\n<b>%d %B %Y</b>\n")
-        movies_list_msg = movies_list_msg + "🎬 " + movie.title + "\n"
-    
-    msg = "Here are the upcoming movie releases in Singapore. To view a movie's information, " \
-            "type /info followed by the full name of the movie.\n" + movies_list_msg
-
-    context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
-
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def listall_navigate(update, context):
+    '''
+    Callback function for the next/previous buttons of the /listall message.
+    '''
+    query = update.callback_query
+    # "listall:<region>:<page>", or "listall:<page>" for the buttons sent before regions existed
+    data = query.data.split(':')
+    listall_region = data[1] if len(data) == 3 and data[1] in DB_MGR.regions else DB_MGR.default_region
+    page_index = int(data[-1])
+    query.answer()
+    text, reply_markup = listall_page_message(page_index, listall_region)
+    query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+def listall_page_message(page_index, region=None):
+    '''
+    Returns the (text, reply_markup) of a page of the /listall message of a region (the default region if None).
+    The page index is clamped, as the number of pages may have changed since the buttons were sent.
+    '''
+    region = region or DB_MGR.default_region
+    pages = get_listall_pages(region)
+    page_index = max(0, min(page_index, len(pages) - 1))
+    if len(pages) == 1:
+        return pages[0], None
+
+    buttons = []
+    if page_index > 0:
+        buttons.append(InlineKeyboardButton("◀ Previous", callback_data="listall:{}:{}".format(region, page_index - 1)))
+    if page_index < len(pages) - 1:
+        buttons.append(InlineKeyboardButton("Next ▶", callback_data="listall:{}:{}".format(region, page_index + 1)))
+    text = pages[page_index] + "\n<i>Page {} of {}</i>".format(page_index + 1, len(pages))
+    return text, InlineKeyboardMarkup([buttons])
+
+def get_listall_pages(region=None):
+    '''
+    Returns the pre-rendered pages of the /listall message for the current movie catalog of a region
+    (the default region if None), rendering them if the catalog changed since they were last rendered.
+    '''
+    region = region or DB_MGR.default_region
+    catalog = DB_MGR.get_catalog(region)
+    rendered_catalog, pages = LISTALL_PAGES.get(region, (None, []))
+    if rendered_catalog is not catalog:
+        pages = render_listall_pages(catalog.movies, region_name(region))
+        LISTALL_PAGES[region] = (catalog, pages)
+    return pages
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def info(update, context):
     '''
     Callback function for /info command.
     Shows the full information of a movie. 
-    The query string must match the movie title exactly (not case sensitive).
+    The query string can be the full title, the start of the title or words of the title (not case sensitive).
+    If several movies match, the user is asked to pick one.
     '''
     chat_id = update.effective_chat.id
     query_str = ' '.join(context.args)
 
-    movies = DB_MGR.get_movies_by_title(query_str)
+    results = DB_MGR.search_movies(query_str, limit=INFO_MAX_CHOICES, region=user_region(chat_id))
 
-    if not movies or len(movies) != 1: # Movie not found
+    if not results: # Movie not found
         msg = "Sorry, we can't find the movie you are looking for ☹ " \
-                "Please ensure that you type the <u>full title</u> of the movie (case-insensitive). " \
-                "If you are unsure of the full title, type /listall and copy and paste the movie title.\n\n" \
+                "Please check the title of the movie, or type the first few words of it. " \
+                "If you are unsure of the title, type /listall and copy and paste the movie title.\n\n" \
                 "❗ Note that we are only able to provide information of upcoming movies in our database " \
                 "(i.e. everything that is listed in /listall)."
         context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
         return
 
+    # Show the movie if it is the only match, or the only exact match
+    exact_matches = [movie for score, movie in results if score == 1.0]
+    if len(results) == 1 or len(exact_matches) == 1:
+        send_movie_info(context.bot, chat_id, exact_matches[0] if exact_matches else results[0][1])
+        return
+
+    # Ask the user to pick one of the matches
+    buttons = [[InlineKeyboardButton("🎬 {} ({})".format(movie.title, movie.year), callback_data="info:" + movie.imdb_id)]
+                for _, movie in results]
+    msg = "Which movie do you mean?"
+    context.bot.send_message(chat_id=chat_id, text=msg, reply_markup=InlineKeyboardMarkup(buttons))
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
+def info_pick(update, context):
+    '''
+    Callback function for the movie choices of the /info command.
+    '''
+    query = update.callback_query
+    imdb_id = query.data.split(':', 1)[1]
+    query.answer()
+
+    movie = DB_MGR.get_catalog(user_region(query.message.chat_id)).by_imdb_id.get(imdb_id)
+    if movie:
+        send_movie_info(context.bot, query.message.chat_id, movie)
+    else:
+        query.edit_message_text(text="Sorry, this movie is no longer in our database ☹ Type /listall to see upcoming movies.")
+
+def send_movie_info(bot, chat_id, target_movie):
+    '''
+    Sends the full information of a movie to a chat.
+    '''
     # Craft movie description text
-    target_movie = movies[0]
     google_query_str = target_movie.title + " " + target_movie.year
     google_link = "https://www.google.com/search?q={}".format(urllib.parse.quote(google_query_str))
     msg = "🎬" + target_movie.title + " (" + target_movie.year + ")\n\n" + \
@@ -151,76 +406,189 @@ def info(update, context):
                     "↘ <b>IMDB Link</b>\n" + "https://www.imdb.com" + target_movie.imdb_link + "\n\n" + \
                     "Not enough information? <a href=\'" + google_link + "\'>🔎 Google it! </a>"
     
-    # Check if poster exists or if the poster link is valid
-    has_poster = False
-    if target_movie.poster_link:
-        resp = requests.get(target_movie.poster_link)
-        if resp.status_code == 200 or resp.status_code == 304:
-            has_poster = True
-
-    if has_poster: # Send poster with caption if there is a poster
-        context.bot.send_photo(chat_id=chat_id, photo=target_movie.poster_link, caption=msg, parse_mode=ParseMode.HTML)
-    else:
-        context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
-
+    # Send poster with caption if there is a poster, reusing the poster already uploaded to Telegram if possible
+    if target_movie.poster_file_id:
+        try:
+            bot.send_photo(chat_id=chat_id, photo=target_movie.poster_file_id, caption=msg, parse_mode=ParseMode.HTML)
+            return
+        except BadRequest:
+            LOGGER.warning("Stored poster file_id of {} was rejected, sending the poster link instead".format(target_movie.imdb_id))
+
+    if target_movie.poster_ok:
+        try:
+            message = bot.send_photo(chat_id=chat_id, photo=target_movie.poster_link, caption=msg, parse_mode=ParseMode.HTML)
+            DB_MGR.set_poster_file_id(target_movie, message.photo[-1].file_id)
+            return
+        except BadRequest as e:
+            # Telegram could not fetch the poster even though the link answered our check
+            LOGGER.warning("Poster of {} was rejected ({}), sending the details without it".format(target_movie.imdb_id, e))
+            DB_MGR.set_poster_not_ok(target_movie)
+
+    bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
+
+@metrics.timed(metrics.HANDLER_SECONDS, 'handler')
 def help(update, context):
     '''
     Callback function for /help command.
     '''
     chat_id = update.effective_chat.id
 
-    msg = "ℹ This bots updates you on upcoming movie releases in Singapore. " \
+    msg = "ℹ This bots updates you on upcoming movie releases in {region}. " \
             "If you wish to be notified whenever there is a new movie released, be sure to type /start. " \
             "If you no longer wish to be notified, type /stop.\n\n" \
             "<b>List of commands:</b>\n\n" \
             "/start: Receive notifications whenever there is a new movie released.\n" \
             "/stop: Stop receiving notifcations from the bot.\n" \
-            "/listall: List all upcoming movie releases in Singapore.\n" \
+            "/subscribe [genre|language] [value]: Only be notified of the movies of some genres or languages. " \
+                "Type /subscribe alone to see your subscriptions.\n" \
+            "/unsubscribe [genre|language] [value]: Remove a subscription.\n" \
+            "/listall: List all upcoming movie releases in {region}.\n" \
+            "/region [region]: Follow the movie releases of another region (e.g. /region my). " \
+                "Type /region alone to see the available regions.\n" \
             "/info [movie_title]: See information about a movie. "\
-                "You must ensure that [movie_title] must be the full title of the movie (case-insensitive).\n" \
+                "[movie_title] can be the full title or the first few words of it (case-insensitive).\n" \
             "/update: Update the database of movie releases. The database will be automatically updated every midnight. " \
-                "However, you can also update the database manually using this command.\n" \
-            "/help: Show this menu"
+                "However, you can also update the database manually using this command (at most once every few minutes).\n" \
+            "/help: Show this menu".format(region=region_name(user_region(chat_id)))
+    if chat_id in ADMIN_CHAT_IDS:
+        msg += "\n\n<b>Admin commands:</b>\n\n" \
+                "/update force: Update the database and refresh the details of every movie.\n" \
+                "/profile [on|off]: Turn profiling of the commands and daily tasks on or off."
     
     context.bot.send_message(chat_id=chat_id, text=msg, parse_mode=ParseMode.HTML)
         
-def update_db(context: CallbackContext):
+@metrics.timed(metrics.JOB_SECONDS, 'job')
+def update_db(context: CallbackContext, force_refresh=False):
     '''
     Fetches movie releases and update the database. Returns True if success.
-    Assumes that the associated DB is already connected and there is already a movies table.
+    Waits for the update that is already running instead of starting another one, if any.
+    A False result marks the daily run as failed, so that another instance retries it (see JobLeases).
+
+    @param force_refresh: If True, ignore the cached OMDb responses and fetch all movie details again.
     '''
-    LOGGER.info("Fetching movies from IMDB...")
-    releases = Releases()
-    movies = releases.fetch_releases()
+    return REFRESHER.run(force_refresh=force_refresh)
 
-    LOGGER.info("Updating movies database...")
+@profiling.profiled('job', 'update_db')
+def refresh_db(progress, force_refresh=False):
+    '''
+    Fetches movie releases and update the database. Returns True if success.
+    Assumes that the associated DB is already connected and there is already a movies table.
+    Only called through REFRESHER, so that a single update runs at a time.
 
-    # Insert movies into db
-    for movie in movies:
-        DB_MGR.upsert_movie(movie)
-    
-    # Remove movies that are expired from the db
-    movies_in_db = DB_MGR.get_movies()
-    date_today = datetime.date.today()
-    for movie in movies_in_db:
-        if date_today > movie.release_date:
-            DB_MGR.delete_movie(movie)
+    @param progress: Function called with a short message after each step.
+    @param force_refresh: If True, ignore the cached OMDb responses and fetch all movie details again.
+    '''
+    state = DB_MGR.get_sync_state()
+    today = datetime.date.today()
+
+    # Ask IMDB for the calendar only if it changed since the last sync, unless the last sync is too old
+    full_sync_max_age = datetime.timedelta(hours=float(os.getenv('FULL_SYNC_MAX_AGE_HOURS', 72)))
+    last_full_sync = state.get('last_full_sync')
+    conditional = not force_refresh and last_full_sync is not None and \
+                    datetime.datetime.utcnow() - datetime.datetime.fromisoformat(last_full_sync) < full_sync_max_age
+    # Movie details deferred by the last sync (OMDb quota, failures) or expiring in the cache are due for a lookup
+    omdb_next_lookup = state.get('omdb_next_lookup')
+    lookups_due = omdb_next_lookup is None or datetime.datetime.fromisoformat(omdb_next_lookup) <= datetime.datetime.utcnow()
+
+    # Fetch the calendar of every region concurrently
+    LOGGER.info("Fetching movies from IMDB ({})...".format(", ".join(DB_MGR.regions)))
+    def fetch_calendar(region):
+        calendar = Releases(region=region)
+        if conditional:
+            movies = calendar.get_imdb_movie_releases(state.get('calendar_etag:' + region),
+                                                        state.get('calendar_last_modified:' + region))
+        else:
+            movies = calendar.get_imdb_movie_releases()
+        return calendar, movies
+    with ThreadPoolExecutor(max_workers=len(DB_MGR.regions)) as executor:
+        calendars = dict(zip(DB_MGR.regions, executor.map(fetch_calendar, DB_MGR.regions)))
+    calendar_hashes = {region: Releases.calendar_hash(movies) if movies is not None else state.get('calendar_hash:' + region)
+                        for region, (_, movies) in calendars.items()}
+
+    if conditional and not lookups_due and \
+            all(calendar_hashes[region] == state.get('calendar_hash:' + region) for region in calendar_hashes):
+        # Nothing to fetch or save, only remove the movies that are expired since the last sync
+        progress("The IMDB calendar has not changed since the last update.")
+        expired_count = DB_MGR.sync_movies({}, today)
+        LOGGER.info("IMDB calendar unchanged, removed {} expired movies".format(expired_count))
+    else:
+        # Every region is synced, so get the full calendars of the regions whose page did not change
+        movies_by_region = {}
+        for region, (calendar, movies) in calendars.items():
+            if movies is None:
+                calendar = Releases(region=region)
+                movies = calendar.get_imdb_movie_releases()
+                calendars[region] = (calendar, movies)
+                calendar_hashes[region] = Releases.calendar_hash(movies)
+            movies_by_region[region] = movies
+
+        # Fetch the details of each movie once, even if it is released in several regions
+        unique_movies = {}
+        for movies in movies_by_region.values():
+            for movie in movies:
+                unique_movies.setdefault(movie.imdb_id, movie)
+        movies = list(unique_movies.values())
+        progress("Found {} upcoming movies on IMDB, fetching their details...".format(len(movies)))
+        releases = Releases(cache=DB_MGR)
+        next_lookup = releases.get_movie_details(movies, force_refresh=force_refresh)
+        known_movies = {}
+        for region in DB_MGR.regions:
+            known_movies.update(DB_MGR.get_catalog(region).by_imdb_id)
+        releases.validate_posters(movies, known_movies)
+        for region_movies in movies_by_region.values():
+            for movie in region_movies:
+                fetched_movie = unique_movies[movie.imdb_id]
+                if movie is not fetched_movie:
+                    for field in DETAIL_FIELDS + ('poster_link', 'poster_ok'):
+                        setattr(movie, field, getattr(fetched_movie, field))
+
+        LOGGER.info("Updating movies database...")
+        progress("Saving the movies...")
+
+        # Upsert movies and remove movies that are expired from the db in one transaction
+        expired_count = DB_MGR.sync_movies(movies_by_region, today)
+        LOGGER.info("Synced {} movies, removed {} expired movies".format(len(movies), expired_count))
+        state_values = {'calendar_hash:' + region: calendar_hash for region, calendar_hash in calendar_hashes.items()}
+        state_values['last_full_sync'] = datetime.datetime.utcnow().isoformat()
+        state_values['omdb_next_lookup'] = (next_lookup or datetime.datetime.max).isoformat()
+        DB_MGR.set_sync_state(state_values)
+
+    # Remember the validators of the calendar pages for the next conditional fetch
+    state_values = {'last_sync': datetime.datetime.utcnow().isoformat()}
+    for region, (calendar, _) in calendars.items():
+        state_values['calendar_etag:' + region] = calendar.calendar_etag
+        state_values['calendar_last_modified:' + region] = calendar.calendar_last_modified
+    DB_MGR.set_sync_state(state_values)
+
+    # Render the /listall pages of the new catalogs once
+    for region in DB_MGR.regions:
+        get_listall_pages(region)
     
     return True
 
+@metrics.timed(metrics.JOB_SECONDS, 'job')
+@profiling.profiled('job')
 def notify_user(context: CallbackContext):
     '''
     Checks if there is a new release on this particular day. If yes, notify user.
     '''
     LOGGER.info("Checking movie releases today...")
 
-    # Get new releases today
-    movies = DB_MGR.get_movies()
+    # Write the recent /start and /stop first, so that they are notified (or not) as expected
+    try:
+        SUBSCRIBERS.flush()
+    except Exception:
+        LOGGER.exception("Failed to write the recent subscriber changes, notifying the users already written")
+
+    # The update may have run on another instance
+    check_catalogs(context)
+
+    # Get new releases today in each region, with the genres and languages used to match the subscriptions
     date_today = datetime.date.today()
-    movies_released = [] # List of movies released today
-    for movie in movies:
-       if date_today == movie.release_date:
-           movies_released.append(movie)
+    movies_released = {region: DB_MGR.get_movies_released_on(date_today, region) for region in DB_MGR.regions}
+    DB_MGR.load_movie_details([movie for movies in movies_released.values() for movie in movies])
+    subscription_index = SubscriptionIndex(DB_MGR.get_subscriptions())
+    digest_of = {region: subscription_index.digests(movies) for region, movies in movies_released.items()}
     
     # Craft movie descriptions
     google_link_template = "https://www.google.com/search?q={}"
@@ -228,38 +596,80 @@ def notify_user(context: CallbackContext):
     movie_desc_template = "🎬 <b>{}</b>\n" \
                             "➡️ <a href=\"{}\">IMDB Link</a>\n" \
                             "➡️ <a href=\"{}\">Search on Google</a>"
-    movies_text = ""
-    for movie in movies_released:
-        query_str = movie.title + " " + movie.year
-        google_link = google_link_template.format(urllib.parse.quote(query_str))
-        full_imdb_link = full_imdb_link_template.format(movie.imdb_link)
-        movie_desc = movie_desc_template.format(movie.title, full_imdb_link, google_link)
-        movies_text = movies_text + movie_desc + "\n\n"
+    movie_descs = {} # Region -> descriptions of the movies released there today
+    for region, movies in movies_released.items():
+        movie_descs[region] = []
+        for movie in movies:
+            query_str = movie.title + " " + movie.year
+            google_link = google_link_template.format(urllib.parse.quote(query_str))
+            full_imdb_link = full_imdb_link_template.format(movie.imdb_link)
+            movie_descs[region].append(movie_desc_template.format(movie.title, full_imdb_link, google_link))
     
     help_text_template = "To see the full information of the movie, " \
                             "type '/info' followed by the full title of the movie (e.g. /info {})"
 
-    # Notify users
-    users = DB_MGR.get_users()
-    for user in users:
-        if movies_released:
-            help_text = help_text_template.format(movies_released[0].title)
-            main_text = "☀ Good morning {}! Here are the movie releases in Singapore today:\n\n{}{}" \
-                        .format(user.first_name, movies_text, help_text)
-            context.bot.send_message(chat_id=user.chat_id, text=main_text, parse_mode=ParseMode.HTML)
+    # Render each distinct digest (greeting template, body) once, users with the same digest share it
+    digests = {}
+    def render_digest(region, movie_indexes):
+        if movie_indexes:
+            greeting_template = "☀ Good morning {}! Here are the movie releases in " + region_name(region) + " today:\n\n"
+            movies_text = "".join(movie_descs[region][i] + "\n\n" for i in movie_indexes)
+            digest_body = movies_text + help_text_template.format(movies_released[region][movie_indexes[0]].title)
+        elif movies_released[region]:
+            greeting_template = "☀ Good morning {}! "
+            digest_body = "None of the movies released in {} today match your subscriptions (see /subscribe). " \
+                            "You can still check out upcoming releases by typing /listall.".format(region_name(region))
         else:
-            main_text = "☀ Good morning {}! Unfortunately, there are no movie releases in Singapore today. " \
-                        "You can still check out upcoming releases by typing /listall." \
-                        .format(user.first_name)
-            try:
-                context.bot.send_message(chat_id=user.chat_id, text=main_text, parse_mode=ParseMode.HTML)
-            except Unauthorized:
-                # User has blocked the bot: remove user from the database
-                DB_MGR.delete_user(user)
-                LOGGER.info("Removed user {} (id: {}) from the database as they have blocked/stopped the bot" \
-                            .format(user.first_name, user.chat_id))
+            greeting_template = "☀ Good morning {}! "
+            digest_body = "Unfortunately, there are no movie releases in {} today. " \
+                            "You can still check out upcoming releases by typing /listall.".format(region_name(region))
+        return greeting_template, digest_body
+
+    def message(user):
+        region = user.region if user.region in movies_released else DB_MGR.default_region
+        key = (region, digest_of[region](user.chat_id))
+        digest = digests.get(key)
+        if digest is None:
+            digest = digests[key] = render_digest(*key)
+        greeting_template, digest_body = digest
+        return user.chat_id, greeting_template.format(user.first_name) + digest_body
+
+    # Notify users
+    users = DB_MGR.iter_users()
+    report = Broadcaster(context.bot).broadcast((message(user) for user in users), parse_mode=ParseMode.HTML)
+
+    # Users who have blocked the bot: remove them from the database
+    removed_count = DB_MGR.delete_users(report.blocked_chat_ids)
+    SUBSCRIBERS.discard(report.blocked_chat_ids)
+    if removed_count:
+        LOGGER.info("Removed {} users from the database as they have blocked/stopped the bot".format(removed_count))
     
-    LOGGER.info("Notified users on today's releases")
+    LOGGER.info("Notified users on today's releases: {}".format(report))
+
+def refresh_if_stale(max_age):
+    '''
+    Starts an update in the background if the last update of the database is older than max_age
+    (or if there was none). Returns True if an update was started.
+
+    @param max_age: datetime.timedelta
+    '''
+    last_sync = DB_MGR.get_sync_state().get('last_sync')
+    if last_sync is not None and datetime.datetime.utcnow() - datetime.datetime.fromisoformat(last_sync) < max_age:
+        LOGGER.info("Serving the movies of the last update ({} UTC)".format(last_sync))
+        return False
+    LOGGER.info("Movies are out of date, updating them in the background...")
+    REFRESHER.request(ignore_cooldown=True)
+    return True
+
+def check_catalogs(context: CallbackContext):
+    '''
+    Reloads the movies served by /listall, /info and the morning notification if they were updated since
+    they were loaded, e.g. by another instance of the bot that ran the daily update.
+    '''
+    if DB_MGR.refresh_catalogs():
+        LOGGER.info("Movies were updated, reloading them...")
+        for region in DB_MGR.regions:
+            get_listall_pages(region)
 
 def wake(context: CallbackContext):
     '''
@@ -267,6 +677,48 @@ def wake(context: CallbackContext):
     '''
     LOGGER.info("Keeping the bot awake with a cup of coffee...")
 
+def add_handlers(dispatcher):
+    '''
+    Register the callback functions of the commands and inline buttons.
+    '''
+    # /start
+    start_handler = CommandHandler('start', start)
+    dispatcher.add_handler(start_handler)
+    # /stop
+    stop_handler = CommandHandler('stop', stop)
+    dispatcher.add_handler(stop_handler)
+    # /subscribe
+    subscribe_handler = CommandHandler('subscribe', subscribe)
+    dispatcher.add_handler(subscribe_handler)
+    # /unsubscribe
+    unsubscribe_handler = CommandHandler('unsubscribe', unsubscribe)
+    dispatcher.add_handler(unsubscribe_handler)
+    # /region
+    region_handler = CommandHandler('region', region)
+    dispatcher.add_handler(region_handler)
+    # /update
+    update_handler = CommandHandler('update', update)
+    dispatcher.add_handler(update_handler)
+    # /profile
+    profile_handler = CommandHandler('profile', profile)
+    dispatcher.add_handler(profile_handler)
+    # /listall
+    listall_handler = CommandHandler('listall', listall)
+    dispatcher.add_handler(listall_handler)
+    listall_navigate_handler = CallbackQueryHandler(listall_navigate, pattern=r'^listall:(\w+:)?\d+$')
+    dispatcher.add_handler(listall_navigate_handler)
+    # /info
+    info_handler = CommandHandler('info', info)
+    dispatcher.add_handler(info_handler)
+    info_pick_handler = CallbackQueryHandler(info_pick, pattern=r'^info:')
+    dispatcher.add_handler(info_pick_handler)
+    # /help
+    help_handler = CommandHandler('help', help)
+    dispatcher.add_handler(help_handler)
+
+    # Profile every callback while profiling is on (PROFILE or /profile)
+    profiling.profile_handlers(dispatcher)
+
 def main():
     # Fetch required variables
     token = os.getenv('TOKEN') # Authentication token for this bot
@@ -278,6 +730,12 @@ def main():
     database_host = os.getenv('DB_HOST') # Database host
     database_url = os.getenv('DATABASE_URL') # For heroku deployment
     heroku_app_name = os.getenv('HEROKU_APP_NAME')
+    workers = int(os.getenv('WORKERS', 4)) # Number of threads running the handlers
+    metrics_port = os.getenv('METRICS_PORT') # Port number to serve the metrics at (not served if not set)
+    update_cooldown = float(os.getenv('UPDATE_COOLDOWN_MINUTES', 10)) # Minimum minutes between two /update
+    startup_max_age = float(os.getenv('STARTUP_REFRESH_MAX_AGE_HOURS', 24)) # Max age of the movies served at startup
+    catalog_check_interval = float(os.getenv('CATALOG_CHECK_SECONDS', 60)) # Seconds between checks for updated movies
+    admin_chat_ids = os.getenv('ADMIN_CHAT_IDS', '') # Comma-separated chat ids allowed to use /profile and /update force
 
     # Check deployment mode
     if mode != 'dev' and mode != 'prod':
@@ -295,40 +753,49 @@ def main():
     else:
         DB_MGR = DatabaseManager(database_name, database_user, database_port, database_host)
 
+    if metrics_port:
+        metrics.start_server(int(metrics_port))
+
+    ADMIN_CHAT_IDS.update(int(chat_id) for chat_id in admin_chat_ids.split(',') if chat_id.strip())
+
+    # Updates of the database run one at a time in the background
+    global REFRESHER
+    REFRESHER = RefreshCoordinator(refresh_db, update_cooldown * 60)
+
     # Connect to db and update tables
     DB_MGR.connect_db(with_pwd=mode=='prod')
     DB_MGR.create_tables()
-    update_db(None)
 
-    updater = Updater(token=token, use_context=True)
+    # /start and /stop are answered from memory and written to the db in batches, the last ones at exit
+    global SUBSCRIBERS
+    SUBSCRIBERS = SubscriberBuffer(DB_MGR).start()
+    atexit.register(SUBSCRIBERS.close)
+
+    # Serve the movies already in the db right away, and only update them in the background if they are stale
+    for region in DB_MGR.regions:
+        get_listall_pages(region)
+    refresh_if_stale(datetime.timedelta(hours=startup_max_age))
+
+    # Time every Bot API call
+    bot = Bot(token, request=metrics.InstrumentedRequest(con_pool_size=workers + 4))
+    updater = Updater(bot=bot, use_context=True, workers=workers)
     dispatcher = updater.dispatcher
 
     # Register periodic tasks
     job_queue = updater.job_queue
     timezone = pytz.timezone('Asia/Singapore')
-    job_queue.run_once(update_db, datetime.time(hour=0, minute=0, second=0, tzinfo=timezone)) # Every midnight
-    job_queue.run_once(notify_user, datetime.time(hour=8, minute=30, second=0, tzinfo=timezone)) # Every 8.30am
+    # The daily jobs run on a single instance even if several instances of the bot are running
+    job_leases = JobLeases(DB_MGR, timezone)
+    job_queue.run_daily(job_leases.daily_job('update_db', update_db),
+                        datetime.time(hour=0, minute=0, second=0, tzinfo=timezone)) # Every midnight
+    job_queue.run_daily(job_leases.daily_job('notify_user', notify_user),
+                        datetime.time(hour=8, minute=30, second=0, tzinfo=timezone)) # Every 8.30am
     job_queue.run_repeating(wake, datetime.timedelta(minutes=10)) # Wake bot every 10 mins
+    # Every instance reloads the movies once another instance updated them
+    job_queue.run_repeating(check_catalogs, datetime.timedelta(seconds=catalog_check_interval))
 
     # Register callback functions
-    # /start
-    start_handler = CommandHandler('start', start)
-    dispatcher.add_handler(start_handler)
-    # /stop
-    stop_handler = CommandHandler('stop', stop)
-    dispatcher.add_handler(stop_handler)
-    # /update
-    update_handler = CommandHandler('update', update)
-    dispatcher.add_handler(update_handler)
-    # /listall
-    listall_handler = CommandHandler('listall', listall)
-    dispatcher.add_handler(listall_handler)
-    # /info
-    info_handler = CommandHandler('info', info)
-    dispatcher.add_handler(info_handler)
-    # /help
-    help_handler = CommandHandler('help', help)
-    dispatcher.add_handler(help_handler)
+    add_handlers(dispatcher)
 
     # Start the bot
     if mode == 'dev':
@@ -0,0 +1,153 @@
+"""
+Latency histograms and error counters, exposed in the Prometheus text format
+"""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from telegram.utils.request import Request
+import bisect
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger()
+
+# Metric names
+HANDLER_SECONDS = 'bot_handler_duration_seconds' # Labelled by command handler
+JOB_SECONDS = 'bot_job_duration_seconds' # Labelled by periodic task
+DB_QUERY_SECONDS = 'bot_db_query_duration_seconds' # Labelled by DatabaseManager method
+UPSTREAM_SECONDS = 'bot_upstream_request_duration_seconds' # Labelled by upstream service (imdb, omdb, poster, telegram)
+
+# Upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Histogram:
+    '''
+    Cumulative histogram of durations for one set of labels.
+    '''
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1) # The last bucket is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+class Registry:
+    '''
+    Thread-safe collection of histograms, keyed by metric name and (label name, label value).
+    '''
+
+    def __init__(self):
+        self.histograms = {} # (metric name, label name, label value) -> Histogram
+        self.lock = threading.Lock()
+
+    def observe(self, metric, label_name, label_value, seconds, error=False):
+        with self.lock:
+            key = (metric, label_name, label_value)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds, error)
+
+    def exposition(self):
+        '''
+        Returns every metric in the Prometheus text format.
+        '''
+        lines = []
+        with self.lock:
+            metrics = sorted(self.histograms.items())
+            previous_metric = None
+            for (metric, label_name, label_value), histogram in metrics:
+                if metric != previous_metric:
+                    lines.append('# TYPE {} histogram'.format(metric))
+                    previous_metric = metric
+                labels = '{}="{}"'.format(label_name, label_value)
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + ('+Inf', ), histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(metric, labels, histogram.total))
+                lines.append('{}_count{{{}}} {}'.format(metric, labels, histogram.count))
+            previous_metric = None
+            for (metric, label_name, label_value), histogram in metrics:
+                if metric != previous_metric:
+                    lines.append('# TYPE {}_errors_total counter'.format(metric))
+                    previous_metric = metric
+                lines.append('{}_errors_total{{{}="{}"}} {}'.format(metric, label_name, label_value, histogram.errors))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+@contextlib.contextmanager
+def track(metric, label_name, label_value):
+    '''
+    Context manager recording the duration of its block, and whether it raised, in a histogram.
+    e.g. with track(UPSTREAM_SECONDS, 'upstream', 'omdb'): ...
+    '''
+    start_time = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        REGISTRY.observe(metric, label_name, label_value, time.perf_counter() - start_time, error=error)
+
+def timed(metric, label_name, label_value=None):
+    '''
+    Decorator recording the duration of each call of the function in a histogram.
+    The label value defaults to the name of the function.
+    '''
+    def decorator(function):
+        value = label_value or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with track(metric, label_name, value):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class InstrumentedRequest(Request):
+    '''
+    Request object of the Telegram bot recording the duration of each Bot API call.
+    '''
+
+    def _request_wrapper(self, *args, **kwargs):
+        with track(UPSTREAM_SECONDS, 'upstream', 'telegram'):
+            return super()._request_wrapper(*args, **kwargs)
+
+def start_server(port):
+    '''
+    Serve the metrics at http://0.0.0.0:<port>/metrics from a background thread.
+    '''
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = REGISTRY.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    LOGGER.info("Serving metrics at port {} (/metrics)".format(port))
+    return server
\ No newline at end of file
@@ -2,9 +2,16 @@
 Contains details of a movie
 """
 
+# Fields that are only loaded from the db when they are first accessed (see Movie.summary)
+DETAIL_FIELDS = ('run_time', 'genre', 'director', 'writer', 'actors', 'plot', 'language', 'country')
+
 class Movie:
+    __slots__ = ('title', 'year', 'imdb_link', 'imdb_id', 'release_date', 'poster_link', 'poster_ok', 'poster_file_id',
+                    'details_loader') + DETAIL_FIELDS
+
     def __init__(self, title='', year='', imdb_link='', imdb_id='', release_date=None, run_time='', genre='', \
-                    director='', writer='', actors='', plot='', language='', country='', poster_link=''):
+                    director='', writer='', actors='', plot='', language='', country='', poster_link='', \
+                    poster_ok=None, poster_file_id=None):
         self.title = title
         self.year = year
         self.imdb_link = imdb_link
@@ -19,7 +26,48 @@ class Movie:
         self.language = language
         self.country = country
         self.poster_link = poster_link
-    
+        self.poster_ok = poster_ok # True if the poster link was found to be valid during the last update
+        self.poster_file_id = poster_file_id # Telegram file_id of the poster once it has been sent
+        self.details_loader = None
+
+    @classmethod
+    def summary(cls, imdb_id, title, year, imdb_link, release_date, poster_link, poster_ok, poster_file_id, details_loader):
+        '''
+        Returns a movie without its detail fields (see DETAIL_FIELDS).
+        They are loaded all at once by calling details_loader(movie) the first time one of them is accessed.
+        '''
+        movie = cls.__new__(cls)
+        movie.imdb_id = imdb_id
+        movie.title = title
+        movie.year = year
+        movie.imdb_link = imdb_link
+        movie.release_date = release_date
+        movie.poster_link = poster_link
+        movie.poster_ok = poster_ok
+        movie.poster_file_id = poster_file_id
+        movie.details_loader = details_loader
+        return movie
+
+    def has_details(self):
+        '''
+        Returns True if the detail fields are loaded.
+        '''
+        return all(self.__is_set(field) for field in DETAIL_FIELDS)
+
+    def __is_set(self, field):
+        try:
+            object.__getattribute__(self, field)
+            return True
+        except AttributeError:
+            return False
+
+    def __getattr__(self, name):
+        # Only called for unset slots, i.e. detail fields of a movie summary that are not loaded yet
+        if name in DETAIL_FIELDS and object.__getattribute__(self, 'details_loader'):
+            self.details_loader(self)
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
     def __str__(self):
         return "\n".join([
             "Title: " + self.title,
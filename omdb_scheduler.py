@@ -0,0 +1,155 @@
+"""
+Keeps the OMDb lookups of an update within the daily request quota of the API key
+"""
+
+import datetime
+import logging
+import random
+import threading
+import time
+
+LOGGER = logging.getLogger()
+
+QUOTA_STATE_KEY = 'omdb_quota' # sync_state key of the quota usage, stored as "<UTC date>:<requests used>"
+
+class QuotaExhaustedError(Exception):
+    '''
+    Raised when no OMDb request is left in the current daily window.
+    '''
+
+class CircuitOpenError(Exception):
+    '''
+    Raised when OMDb failed too many times in a row and requests are not sent for a while.
+    '''
+
+class TransientOmdbError(Exception):
+    '''
+    Raised for OMDb responses worth retrying (rate limited or server errors).
+    '''
+
+class OmdbResponseError(Exception):
+    '''
+    Raised for OMDb error responses other than an unknown title (e.g. invalid API key), not worth retrying right away.
+    '''
+
+class OmdbQuota:
+    '''
+    Number of OMDb requests left in the current daily window (reset at midnight UTC).
+    If a state store (e.g. a DatabaseManager) is given, the usage is loaded from and saved to its sync_state,
+    so that it is shared by every update of the day.
+    '''
+
+    def __init__(self, daily_limit, state=None):
+        self.daily_limit = daily_limit
+        self.state = state
+        self.window = datetime.datetime.utcnow().date()
+        self.used = 0
+        self.lock = threading.Lock()
+        if state:
+            window, _, used = (state.get_sync_state().get(QUOTA_STATE_KEY) or '').partition(':')
+            if window == self.window.isoformat():
+                self.used = int(used)
+
+    def remaining(self):
+        with self.lock:
+            self.__roll_window()
+            return max(self.daily_limit - self.used, 0)
+
+    def acquire(self):
+        '''
+        Use one request of the quota. Raises QuotaExhaustedError if none is left.
+        '''
+        with self.lock:
+            self.__roll_window()
+            if self.used >= self.daily_limit:
+                raise QuotaExhaustedError("Daily limit of {} OMDb requests reached".format(self.daily_limit))
+            self.used += 1
+
+    def exhaust(self):
+        '''
+        Mark the quota of the current window as used up (e.g. OMDb answered that the limit is reached).
+        '''
+        with self.lock:
+            self.__roll_window()
+            self.used = max(self.used, self.daily_limit)
+
+    def save(self):
+        if self.state:
+            with self.lock:
+                value = '{}:{}'.format(self.window.isoformat(), self.used)
+            self.state.set_sync_state({QUOTA_STATE_KEY: value})
+
+    def __roll_window(self):
+        today = datetime.datetime.utcnow().date()
+        if today != self.window:
+            self.window = today
+            self.used = 0
+
+class CircuitBreaker:
+    '''
+    Stops sending requests for reset_timeout seconds after failure_threshold consecutive failures.
+    Once the timeout is over, a single request is let through: the circuit closes again if it succeeds.
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0 # Consecutive failures
+        self.opened_at = None # time.monotonic() of when the circuit opened, None if closed
+        self.trial_running = False # True while the request testing a half-open circuit runs
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        '''
+        Raises CircuitOpenError if the request must not be sent.
+        '''
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("OMDb failed {} times in a row".format(self.failures))
+            self.trial_running = True
+
+    def cancel_request(self):
+        '''
+        The request allowed by before_request was not sent: let the next one test the circuit instead.
+        '''
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    LOGGER.warning("OMDb failed {} times in a row, pausing requests for {}s"
+                                    .format(self.failures, self.reset_timeout))
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+def backoff_delay(attempt, base_delay, max_delay=30):
+    '''
+    Returns the number of seconds to wait before retry number attempt (starting at 0),
+    with "full jitter": random between 0 and base_delay * 2^attempt (capped at max_delay).
+    '''
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def prioritize(movies, cached):
+    '''
+    Returns the movies in the order their details should be fetched:
+    movies without any details first, then movies with stale details, each by soonest release date.
+
+    @param cached: Dict of imdb_id -> cached OMDb response of the movies that have one.
+    '''
+    def priority(movie):
+        has_details = movie.imdb_id in cached and cached[movie.imdb_id].get('Response') == 'True'
+        if movie.release_date is None:
+            return (has_details, True, 0)
+        return (has_details, False, movie.release_date.toordinal())
+    return sorted(movies, key=priority)
@@ -0,0 +1,155 @@
+"""
+Opt-in cProfile and tracemalloc snapshots of the handlers and scheduled jobs
+"""
+
+import cProfile
+import datetime
+import functools
+import logging
+import os
+import threading
+import tracemalloc
+
+LOGGER = logging.getLogger()
+
+TOP_ALLOCATIONS = 50 # Number of allocation sites written in each allocation snapshot
+
+class Profiler:
+    '''
+    Profiles each invocation of the wrapped functions while enabled, and writes for each of them:
+        - <time>-<kind>-<name>.prof: cProfile statistics (open with pstats or snakeviz)
+        - <time>-<kind>-<name>.alloc.txt: top allocation sites (tracemalloc) during the invocation
+    The oldest files of the directory are deleted once it grows over max_bytes.
+    cProfile only sees the thread running the function: threads it starts are not profiled.
+    A single invocation is profiled at a time (Python 3.12+ allows a single active profiler per process):
+    invocations made while another one is profiled run unprofiled.
+    '''
+
+    def __init__(self, directory=None, max_bytes=None, enabled=None, frames=None):
+        self.directory = directory or os.getenv('PROFILE_DIR', 'profiles')
+        self.max_bytes = max_bytes or int(float(os.getenv('PROFILE_MAX_MB', 100)) * 1024 * 1024)
+        self.frames = frames or int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', 10)) # Frames kept per allocation
+        self.enabled = False
+        self.active = threading.local() # active.profiling is True while this thread runs a profiled function
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock() # Held while an invocation is profiled
+        if enabled or (enabled is None and os.getenv('PROFILE', '').lower() in ('1', 'true', 'yes', 'on')):
+            self.enable()
+
+    def enable(self):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self.enabled = True
+        LOGGER.info("Profiling enabled, writing profiles to {}".format(os.path.abspath(self.directory)))
+
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+        LOGGER.info("Profiling disabled")
+
+    def status(self):
+        '''
+        Returns (enabled, number of files, total size in bytes) of the profile directory.
+        '''
+        files = self.__files()
+        return self.enabled, len(files), sum(size for _, size, _ in files)
+
+    def call(self, kind, name, function, *args, **kwargs):
+        '''
+        Calls function(*args, **kwargs), profiling it if profiling is enabled.
+        Calls made while this thread is already profiling (e.g. a job calling a handler) are not profiled separately,
+        and calls made while another thread is profiling are not profiled at all.
+        '''
+        if not self.enabled or getattr(self.active, 'profiling', False):
+            return function(*args, **kwargs)
+        if not self.profile_lock.acquire(blocking=False):
+            return function(*args, **kwargs)
+
+        try:
+            self.active.profiling = True
+            profile = cProfile.Profile()
+            tracing = tracemalloc.is_tracing()
+            before = tracemalloc.take_snapshot() if tracing else None
+            try:
+                return profile.runcall(function, *args, **kwargs)
+            finally:
+                after = tracemalloc.take_snapshot() if tracing and tracemalloc.is_tracing() else None
+                self.active.profiling = False
+                try:
+                    self.__write(kind, name, profile, before, after)
+                except Exception:
+                    LOGGER.exception("Failed to write the profile of {} {}".format(kind, name))
+        finally:
+            self.profile_lock.release()
+
+    def __write(self, kind, name, profile, before, after):
+        prefix = os.path.join(self.directory, '{:%Y%m%d-%H%M%S-%f}-{}-{}'.format(datetime.datetime.utcnow(), kind, name))
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(prefix + '.prof')
+        if before is not None and after is not None:
+            stats = after.compare_to(before, 'lineno')
+            with open(prefix + '.alloc.txt', 'w') as alloc_file:
+                alloc_file.write("Top {} allocation sites of {} {} (size and count differences)\n"
+                                    .format(TOP_ALLOCATIONS, kind, name))
+                for stat in stats[:TOP_ALLOCATIONS]:
+                    alloc_file.write(str(stat) + '\n')
+        self.__rotate()
+
+    def __rotate(self):
+        '''
+        Delete the oldest files of the directory until its size is under max_bytes.
+        '''
+        with self.lock:
+            files = sorted(self.__files(), key=lambda file: file[2])
+            total = sum(size for _, size, _ in files)
+            for path, size, _ in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+    def __files(self):
+        '''
+        Returns the (path, size, modification time) of the profile files.
+        '''
+        files = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return files
+        for entry in entries:
+            if entry.is_file() and (entry.name.endswith('.prof') or entry.name.endswith('.alloc.txt')):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+PROFILER = Profiler()
+
+def profiled(kind, name=None):
+    '''
+    Decorator profiling each call of the function with PROFILER while profiling is enabled.
+    The name defaults to the name of the function.
+    '''
+    def decorator(function):
+        profile_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return PROFILER.call(kind, profile_name, function, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def profile_handlers(dispatcher, kind='handler'):
+    '''
+    Wrap the callback of every handler registered in the dispatcher with profiled().
+    '''
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handler.callback = profiled(kind)(handler.callback)
@@ -0,0 +1,129 @@
+"""
+Runs database refreshes in the background, one at a time
+"""
+
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger()
+
+STARTED = 'started' # A new refresh was started
+JOINED = 'joined' # A refresh was already running, the caller is notified when it finishes
+RECENT = 'recent' # A refresh finished less than the cooldown ago, nothing was started
+
+class RefreshRun:
+    '''
+    A refresh that is running or has finished, with the callbacks of everyone waiting for it.
+    '''
+
+    def __init__(self):
+        self.listeners = [] # (on_progress, on_done) tuples
+        self.result = None
+        self.finished_at = None # time.monotonic() of the end of the run
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_listener(self, on_progress, on_done):
+        with self.lock:
+            self.listeners.append((on_progress, on_done))
+
+    def progress(self, text):
+        '''
+        Forward a progress message to every listener.
+        '''
+        with self.lock:
+            listeners = list(self.listeners)
+        for on_progress, _ in listeners:
+            if on_progress:
+                self.__call(on_progress, text)
+
+    def finish(self, result):
+        with self.lock:
+            self.result = result
+            self.finished_at = time.monotonic()
+            listeners = list(self.listeners)
+        self.finished.set()
+        for _, on_done in listeners:
+            if on_done:
+                self.__call(on_done, result)
+
+    def __call(self, callback, arg):
+        try:
+            callback(arg)
+        except Exception:
+            LOGGER.exception("Refresh listener failed")
+
+class RefreshCoordinator:
+    '''
+    Makes sure that at most one refresh runs at a time. Requests made while a refresh is running
+    attach to it, and requests made less than "cooldown" seconds after a refresh finished reuse its result.
+    '''
+
+    def __init__(self, refresh, cooldown):
+        '''
+        @param refresh: Function called as refresh(progress, force_refresh) that returns True if success.
+                        progress is a function taking a progress message.
+        @param cooldown: Minimum number of seconds between the end of a refresh and the start of the next one.
+        '''
+        self.refresh = refresh
+        self.cooldown = cooldown
+        self.current_run = None # Running RefreshRun, if any
+        self.last_run = None # Last finished RefreshRun, if any
+        self.lock = threading.Lock()
+
+    def request(self, on_progress=None, on_done=None, force_refresh=False, ignore_cooldown=False):
+        '''
+        Request a refresh in the background. Returns STARTED, JOINED or RECENT.
+        on_progress is called with each progress message and on_done with the result of the refresh,
+        unless RECENT is returned (see seconds_since_last_run and last_result).
+        '''
+        with self.lock:
+            if self.current_run:
+                self.current_run.add_listener(on_progress, on_done)
+                return JOINED
+            if not ignore_cooldown and self.seconds_since_last_run() < self.cooldown:
+                return RECENT
+            run = RefreshRun()
+            run.add_listener(on_progress, on_done)
+            self.current_run = run
+
+        thread = threading.Thread(target=self.__run, args=(run, force_refresh), name='refresh', daemon=True)
+        thread.start()
+        return STARTED
+
+    def run(self, force_refresh=False):
+        '''
+        Start a refresh (or attach to the running one) and wait for it to finish. Returns its result.
+        Used by the periodic update, which ignores the cooldown.
+        '''
+        with self.lock:
+            run = self.current_run
+        if run is None:
+            self.request(force_refresh=force_refresh, ignore_cooldown=True)
+            with self.lock:
+                run = self.current_run or self.last_run
+        run.finished.wait()
+        return run.result
+
+    def seconds_since_last_run(self):
+        '''
+        Returns the number of seconds since the last refresh finished (infinity if there was none).
+        '''
+        last_run = self.last_run
+        return time.monotonic() - last_run.finished_at if last_run else float('inf')
+
+    @property
+    def last_result(self):
+        return self.last_run.result if self.last_run else None
+
+    def __run(self, run, force_refresh):
+        try:
+            result = self.refresh(run.progress, force_refresh)
+        except Exception:
+            LOGGER.exception("Failed to refresh the database")
+            result = False
+        with self.lock:
+            self.current_run = None
+            self.last_run = run
+        run.finish(result)
\ No newline at end of file
@@ -2,82 +2,366 @@
 Fetches movie releases from IMDB
 """
 
-from bs4 import BeautifulSoup
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from imdb_calendar import ImdbCalendarParser
+from imdb_calendar import soup_calendar_entries
 from movie import Movie
+from omdb_scheduler import CircuitBreaker
+from omdb_scheduler import CircuitOpenError
+from omdb_scheduler import OmdbQuota
+from omdb_scheduler import OmdbResponseError
+from omdb_scheduler import QuotaExhaustedError
+from omdb_scheduler import TransientOmdbError
+from requests.adapters import HTTPAdapter
+import codecs
 import datetime
+import hashlib
 import json
+import logging
+import metrics
+import omdb_scheduler
 import os
 import requests
+import time
+
+LOGGER = logging.getLogger()
+
+OMDB_NOT_FOUND_ERROR = 'Movie not found!' # Error of OMDb for titles it does not know about (yet)
+OMDB_LIMIT_ERROR = 'Request limit reached!' # Error of OMDb once the daily limit of the API key is reached
 
 class Releases:
 
-    def __init__(self):
+    def __init__(self, max_workers=None, timeout=None, cache=None, region='sg'):
         self.movie_releases = [] # List of Movie objects fetched
+        self.region = region # Region of the IMDB release calendar
+        self.imdb_movie_releases_link = os.getenv('IMDB_CALENDAR_URL', 'https://www.imdb.com/calendar/?region={region}') \
+                                            .format(region=region)
+        self.omdb_api_url = os.getenv('OMDB_API_URL', 'http://www.omdbapi.com/')
+        self.parser = os.getenv('IMDB_PARSER', 'streaming') # 'streaming' or 'soup'
+        self.cache = cache # Persistent OMDb response cache and quota usage (e.g. a DatabaseManager), optional
+        self.cache_ttl = datetime.timedelta(days=float(os.getenv('OMDB_CACHE_TTL_DAYS', 7)))
+        self.cache_miss_ttl = datetime.timedelta(hours=float(os.getenv('OMDB_CACHE_MISS_TTL_HOURS', 12)))
+        self.max_workers = max_workers or int(os.getenv('OMDB_MAX_WORKERS', 8)) # Max concurrent OMDb requests
+        self.timeout = timeout or float(os.getenv('HTTP_TIMEOUT', 10)) # Per-request timeout in seconds
+        self.omdb_daily_limit = int(os.getenv('OMDB_DAILY_LIMIT', 1000)) # Requests allowed per day by the API key
+        self.max_retries = int(os.getenv('OMDB_MAX_RETRIES', 3)) # Retries of a failed OMDb request
+        self.retry_base_delay = float(os.getenv('OMDB_RETRY_BASE_DELAY', 0.5)) # Seconds, doubled at each retry
+        self.breaker = CircuitBreaker(int(os.getenv('OMDB_BREAKER_THRESHOLD', 5)),
+                                        float(os.getenv('OMDB_BREAKER_RESET_SECONDS', 60)))
+        self.calendar_etag = None # ETag of the last IMDB calendar response
+        self.calendar_last_modified = None # Last-Modified of the last IMDB calendar response
+        self.calendar_not_modified = False # True if IMDB answered that the calendar did not change
 
-    def fetch_releases(self):
+        # Shared keep-alive session, with enough pooled connections for every worker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_releases(self, force_refresh=False):
         '''
         Fetches the movie releases and populate the movie_releases list.
+
+        @param force_refresh: If True, ignore cached OMDb responses and fetch every title again.
         '''
         self.movie_releases = self.get_imdb_movie_releases()
-        self.get_movie_details(self.movie_releases)
+        self.get_movie_details(self.movie_releases, force_refresh=force_refresh)
 
         return self.movie_releases
     
-    def get_movie_details(self, movies):
+    def get_movie_details(self, movies, force_refresh=False):
         '''
         Populate the movie details in the list of movies through the OMDb API.
         The movie details are found using its imdb_id.
+        Requests are sent concurrently (up to OMDB_MAX_WORKERS at a time) over a shared session.
+        If a cache is set, only titles that are not cached or whose cache entry expired are fetched,
+        and cache entries of titles that are no longer in the list of movies are evicted.
+        At most OMDB_DAILY_LIMIT requests are sent per day: titles without details are fetched first,
+        then the ones releasing soonest. Titles left over, or whose request failed, keep their stale cached
+        details and are fetched by a later update.
+        Returns when the details of a movie should next be looked up (UTC): now if lookups were deferred,
+        else when the first cache entry of the movies expires (None if there are no movies or no cache).
+
+        @param force_refresh: If True, ignore cached OMDb responses and fetch every title again.
         '''
-        # Get OMDb API key
-        try:
-            api_key = os.environ['OMDB_API_KEY']
-        except KeyError:
-            raise KeyError('OMDb API key not found! Ensure that your OMDb API key is in the "OMDB_API_KEY" environment variable!')
+        # Serve what we can from the cache
+        movies_to_fetch = movies
+        stale = {} # imdb_id -> expired cached OMDb response
+        now = datetime.datetime.utcnow()
+        next_lookup = None
+        if self.cache:
+            cached = self.cache.get_omdb_cache(movie.imdb_id for movie in movies)
+            movies_to_fetch = []
+            for movie in movies:
+                entry = cached.get(movie.imdb_id)
+                if entry and not force_refresh and entry[1] > now:
+                    self.__set_movie_details(movie, entry[0])
+                    next_lookup = min(next_lookup or entry[1], entry[1])
+                else:
+                    movies_to_fetch.append(movie)
+                    if entry:
+                        stale[movie.imdb_id] = entry[0]
+            LOGGER.info("{} of {} titles served from the OMDb cache".format(len(movies) - len(movies_to_fetch), len(movies)))
+
+        if movies_to_fetch:
+            # Get OMDb API key
+            try:
+                api_key = os.environ['OMDB_API_KEY']
+            except KeyError:
+                raise KeyError('OMDb API key not found! Ensure that your OMDb API key is in the "OMDB_API_KEY" environment variable!')
+
+            omdb_url_by_id = self.omdb_api_url + '?i={}&apikey=' + api_key
+
+            # Spend the requests left today on the titles that need them most
+            quota = OmdbQuota(self.omdb_daily_limit, state=self.cache)
+            movies_to_fetch = omdb_scheduler.prioritize(movies_to_fetch, stale)
+            deferred = movies_to_fetch[quota.remaining():]
+            movies_to_fetch = movies_to_fetch[:quota.remaining()]
+
+            # Get the movie details through OMDb API (search by IMDB id)
+            fetched = []
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.__fetch_details, omdb_url_by_id.format(movie.imdb_id), quota): movie
+                            for movie in movies_to_fetch}
+                for future in as_completed(futures):
+                    movie = futures[future]
+                    try:
+                        full_details = future.result()
+                    except (QuotaExhaustedError, CircuitOpenError):
+                        deferred.append(movie)
+                        continue
+                    except (requests.RequestException, TransientOmdbError, OmdbResponseError, ValueError) as e:
+                        LOGGER.warning("Failed to fetch details of {} from OMDb: {}".format(movie.imdb_id, e))
+                        deferred.append(movie)
+                        continue
+                    self.__set_movie_details(movie, full_details)
+                    fetched.append((movie.imdb_id, full_details))
+            quota.save()
+
+            # Fall back to the stale details of the titles that were not fetched
+            for movie in deferred:
+                if movie.imdb_id in stale:
+                    self.__set_movie_details(movie, stale[movie.imdb_id])
+            if deferred:
+                LOGGER.info("Deferred {} OMDb lookups to a later update ({} requests left today)"
+                            .format(len(deferred), quota.remaining()))
+                next_lookup = now
+
+            if self.cache:
+                entries = [(imdb_id, details, self.__cache_expiry(details)) for imdb_id, details in fetched]
+                self.cache.store_omdb_cache(entries)
+                for _, _, expiry in entries:
+                    next_lookup = min(next_lookup or expiry, expiry)
+
+        if self.cache and movies:
+            self.cache.evict_omdb_cache(movie.imdb_id for movie in movies)
+        return next_lookup if self.cache else None
 
-        omdb_url_by_id = 'http://www.omdbapi.com/?i={}&apikey=' + api_key
+    def __cache_expiry(self, full_details):
+        '''
+        Returns when a cached OMDb response should expire. Titles that OMDb does not know about yet
+        expire sooner so that their details are picked up soon after they are added.
+        Only found titles and OMDB_NOT_FOUND_ERROR responses are cached, other errors are raised by __fetch_details.
+        '''
+        if full_details.get('Response') == 'True':
+            return datetime.datetime.utcnow() + self.cache_ttl
+        return datetime.datetime.utcnow() + self.cache_miss_ttl
+
+    def validate_posters(self, movies, known_movies=None):
+        '''
+        Set "poster_ok" of each movie to whether its poster link can be downloaded.
+        Links are checked concurrently with HEAD requests.
 
-        # Get the movie details through OMDb API (search by IMDB id)
+        @param known_movies: Dict of imdb_id -> Movie object from the previous update. A poster that was
+                             valid then and whose link has not changed is not checked again.
+        '''
+        known_movies = known_movies or {}
+        movies_to_check = []
         for movie in movies:
-            response = requests.get(omdb_url_by_id.format(movie.imdb_id))
-            full_details = json.loads(response.text)
-            if full_details['Response'] == 'True':
-                movie.run_time = full_details['Runtime']
-                movie.genre = full_details['Genre']
-                movie.director = full_details['Director']
-                movie.writer = full_details['Writer']
-                movie.actors = full_details['Actors']
-                movie.plot = full_details['Plot']
-                movie.language = full_details['Language']
-                movie.country = full_details['Country']
-                movie.poster_link = full_details['Poster']
-
-    def get_imdb_movie_releases(self):
+            known_movie = known_movies.get(movie.imdb_id)
+            if not movie.poster_link.startswith('http'): # OMDb uses 'N/A' when there is no poster
+                movie.poster_ok = False
+            elif known_movie and known_movie.poster_ok and known_movie.poster_link == movie.poster_link:
+                movie.poster_ok = True
+            else:
+                movies_to_check.append(movie)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for movie, poster_ok in zip(movies_to_check, executor.map(self.__check_link, movies_to_check)):
+                movie.poster_ok = poster_ok
+
+    def __check_link(self, movie):
+        '''
+        Returns True if the poster link of the movie responds with a success status.
+        '''
+        try:
+            with metrics.track(metrics.UPSTREAM_SECONDS, 'upstream', 'poster'):
+                response = self.session.head(movie.poster_link, timeout=self.timeout, allow_redirects=True)
+                if response.status_code == 405: # HEAD not allowed, fall back to GET without reading the body
+                    response = self.session.get(movie.poster_link, timeout=self.timeout, stream=True)
+                    response.close()
+        except requests.RequestException as e:
+            LOGGER.warning("Failed to check the poster of {}: {}".format(movie.imdb_id, e))
+            return False
+        return response.status_code == 200 or response.status_code == 304
+
+    def __fetch_details(self, url, quota):
+        '''
+        GET an OMDb url and return the decoded JSON body, retrying transient failures with jittered backoff.
+        Each request (retries included) uses one request of the quota.
+        Raises QuotaExhaustedError or CircuitOpenError if the request could not be sent, and OmdbResponseError
+        for error responses other than an unknown title (e.g. invalid API key).
+        Every outcome other than a found or unknown title counts as a failure for the circuit breaker.
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.breaker.before_request()
+            try:
+                quota.acquire()
+            except QuotaExhaustedError:
+                self.breaker.cancel_request()
+                raise
+            try:
+                status_code, full_details = self.__fetch_json(url)
+            except (requests.ConnectionError, requests.Timeout, TransientOmdbError):
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(omdb_scheduler.backoff_delay(attempt, self.retry_base_delay))
+                continue
+            except Exception:
+                self.breaker.record_failure()
+                raise
+
+            error = full_details.get('Error')
+            if error == OMDB_LIMIT_ERROR:
+                # OMDb is up, the API key has no requests left today
+                self.breaker.record_success()
+                quota.exhaust()
+                raise QuotaExhaustedError("OMDb request limit reached")
+            if status_code < 400 and (full_details.get('Response') == 'True' or error == OMDB_NOT_FOUND_ERROR):
+                self.breaker.record_success()
+                return full_details
+            self.breaker.record_failure()
+            raise OmdbResponseError("OMDb answered {}: {}".format(status_code, error))
+
+    def __fetch_json(self, url):
+        '''
+        GET the given url with the shared session and return the status code and the decoded JSON body.
+        Raises TransientOmdbError if the server is rate limiting or failing.
+        '''
+        with metrics.track(metrics.UPSTREAM_SECONDS, 'upstream', 'omdb'):
+            response = self.session.get(url, timeout=self.timeout)
+            if response.status_code == 429 or response.status_code >= 500:
+                raise TransientOmdbError("OMDb answered {}".format(response.status_code))
+            return response.status_code, json.loads(response.text)
+
+    def __set_movie_details(self, movie, full_details):
+        '''
+        Copy the fields of an OMDb response into the movie object.
+        '''
+        if full_details.get('Response') == 'True':
+            movie.run_time = full_details['Runtime']
+            movie.genre = full_details['Genre']
+            movie.director = full_details['Director']
+            movie.writer = full_details['Writer']
+            movie.actors = full_details['Actors']
+            movie.plot = full_details['Plot']
+            movie.language = full_details['Language']
+            movie.country = full_details['Country']
+            movie.poster_link = full_details['Poster']
+
+    def get_imdb_movie_releases(self, etag=None, last_modified=None):
         '''
         Retrieves upcoming movie releases from the IMDB page.
-        Returns a list of Movie objects with populated "title", "year", "release_date", "imdb_id" and "imdb_link" values.
+        Returns a list of Movie objects with populated "title", "year", "release_date", "imdb_id" and "imdb_link" values,
+        or None if the page did not change since the response with the given ETag/Last-Modified.
+        Uses the streaming parser unless the IMDB_PARSER environment variable is set to "soup".
+        '''
+        if self.parser == 'soup':
+            movies = self.__soup_imdb_movie_releases(etag, last_modified)
+        else:
+            movies = list(self.iter_imdb_movie_releases(etag, last_modified))
+        return None if self.calendar_not_modified else movies
+
+    def iter_imdb_movie_releases(self, etag=None, last_modified=None):
+        '''
+        Same as get_imdb_movie_releases, but downloads and parses the IMDB page in chunks
+        and yields the Movie objects as soon as they are parsed.
+        Yields nothing if the page did not change (calendar_not_modified is then set).
+        '''
+        parser = ImdbCalendarParser()
+        with metrics.track(metrics.UPSTREAM_SECONDS, 'upstream', 'imdb'), \
+                self.__get_calendar(etag, last_modified, stream=True) as response:
+            if self.calendar_not_modified:
+                return
+            decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                parser.feed(decoder.decode(chunk))
+                yield from self.__drain_calendar_entries(parser)
+            parser.feed(decoder.decode(b'', final=True))
+            parser.close()
+            yield from self.__drain_calendar_entries(parser)
+
+    def __get_calendar(self, etag, last_modified, stream=False):
+        '''
+        Sends a conditional GET for the IMDB calendar page and records the validators of the response.
+        '''
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = self.session.get(self.imdb_movie_releases_link, headers=headers, timeout=self.timeout, stream=stream)
+        self.calendar_not_modified = response.status_code == 304
+        self.calendar_etag = response.headers.get('ETag', etag)
+        self.calendar_last_modified = response.headers.get('Last-Modified', last_modified)
+        return response
+
+    @staticmethod
+    def calendar_hash(movies):
+        '''
+        Returns a hash of the (imdb_id, release_date) pairs of the movies, independent of their order.
+        '''
+        pairs = sorted('{}|{:%Y-%m-%d}'.format(movie.imdb_id, movie.release_date) for movie in movies)
+        return hashlib.sha256('\n'.join(pairs).encode('utf-8')).hexdigest()
+
+    def __drain_calendar_entries(self, parser):
+        '''
+        Yields Movie objects for the entries parsed so far and clears them from the parser.
+        '''
+        entries, parser.entries = parser.entries, []
+        for release_date_text, title_text, imdb_link in entries:
+            yield self.__calendar_entry_to_movie(self.__imdb_date_to_datetime(release_date_text), title_text, imdb_link)
+
+    def __soup_imdb_movie_releases(self, etag, last_modified):
+        '''
+        Retrieves upcoming movie releases by building the full BeautifulSoup tree of the IMDB page.
         '''
-        imdb_movie_releases_link = 'https://www.imdb.com/calendar/?region=sg'
         movies = []
 
         # Fetch IMDB page
-        response = requests.get(imdb_movie_releases_link)
-        page = response.content
+        with metrics.track(metrics.UPSTREAM_SECONDS, 'upstream', 'imdb'):
+            response = self.__get_calendar(etag, last_modified)
+            page = response.content
+        if self.calendar_not_modified:
+            return movies
 
         # Parse the page and get movie releases info
-        soup = BeautifulSoup(page, 'html.parser')
-        main_div = soup.find(id='main')
-        release_dates_h4 = main_div.find_all('h4')
-        for release_date_element in release_dates_h4:
-            release_date = self.__imdb_date_to_datetime(release_date_element.text)
-            titles_li = release_date_element.find_next('ul').find_all('li')
-            for title_element in titles_li:
-                title, year = title_element.text.strip().strip('\n').rsplit(' ', 1)
-                year = year.strip('(').strip(')')
-                imdb_link = title_element.a['href']
-                imdb_id = imdb_link.split('/')[2]
-                movies.append(Movie(title=title, year=year, imdb_link=imdb_link, imdb_id=imdb_id, release_date=release_date))
+        for release_date_text, title_text, imdb_link in soup_calendar_entries(page):
+            release_date = self.__imdb_date_to_datetime(release_date_text)
+            movies.append(self.__calendar_entry_to_movie(release_date, title_text, imdb_link))
         
         return movies
+
+    def __calendar_entry_to_movie(self, release_date, title_text, imdb_link):
+        '''
+        Returns a Movie object from a list item of the IMDB calendar (e.g. 'Tenet (2020)' linking to '/title/tt6723592/').
+        '''
+        title, year = ' '.join(title_text.split()).rsplit(' ', 1) # Line breaks and indentation collapsed
+        year = year.strip('(').strip(')')
+        imdb_id = imdb_link.split('/')[2]
+        return Movie(title=title, year=year, imdb_link=imdb_link, imdb_id=imdb_id, release_date=release_date)
     
     def __imdb_date_to_datetime(self, imdb_date):
         ''' 
@@ -2,6 +2,9 @@
 SQL queries strings
 """
 
+# Check that a connection still works
+PING = 'SELECT 1;'
+
 # Craete movies table
 CREATE_MOVIES_TABLE = 'CREATE TABLE IF NOT EXISTS movies ( \
     imdb_id varchar(20) PRIMARY KEY, \
@@ -17,9 +20,19 @@ CREATE_MOVIES_TABLE = 'CREATE TABLE IF NOT EXISTS movies ( \
     plot text, \
     language text, \
     country text, \
-    poster_link text \
+    poster_link text, \
+    poster_ok boolean, \
+    poster_file_id text \
 );'
 
+# Add the poster columns to a movies table created before they existed
+ADD_MOVIES_POSTER_COLUMNS = 'ALTER TABLE movies \
+    ADD COLUMN IF NOT EXISTS poster_ok boolean, \
+    ADD COLUMN IF NOT EXISTS poster_file_id text;'
+
+# Drop the index of movies by release date, the date range queries use the movie_releases index instead
+DROP_MOVIES_RELEASE_DATE_INDEX = 'DROP INDEX IF EXISTS movies_release_date_idx;'
+
 # Insert a movie object in the movies table
 INSERT_MOVIE = 'INSERT INTO movies (imdb_id, title, year, imdb_link, release_date, run_time, genre, director, \
                                     writer, actors, plot, language, country, poster_link) \
@@ -31,14 +44,83 @@ UPDATE_MOVIE = 'UPDATE movies \
                     writer=%s, actors=%s, plot=%s, language=%s, country=%s, poster_link=%s \
                 WHERE imdb_id=%s;'
 
+# Insert or update movie objects in the movies table (used with execute_values).
+# The Telegram file_id of the poster is kept as long as the poster link does not change.
+UPSERT_MOVIES = 'INSERT INTO movies (imdb_id, title, year, imdb_link, release_date, run_time, genre, director, \
+                                    writer, actors, plot, language, country, poster_link, poster_ok) \
+                VALUES %s \
+                ON CONFLICT (imdb_id) DO UPDATE \
+                SET title=EXCLUDED.title, year=EXCLUDED.year, imdb_link=EXCLUDED.imdb_link, \
+                    release_date=EXCLUDED.release_date, run_time=EXCLUDED.run_time, genre=EXCLUDED.genre, \
+                    director=EXCLUDED.director, writer=EXCLUDED.writer, actors=EXCLUDED.actors, plot=EXCLUDED.plot, \
+                    language=EXCLUDED.language, country=EXCLUDED.country, poster_link=EXCLUDED.poster_link, \
+                    poster_ok=EXCLUDED.poster_ok, \
+                    poster_file_id=CASE WHEN movies.poster_link IS NOT DISTINCT FROM EXCLUDED.poster_link \
+                                        THEN movies.poster_file_id ELSE NULL END;'
+
+# Set the Telegram file_id of a movie poster
+UPDATE_MOVIE_POSTER_FILE_ID = 'UPDATE movies SET poster_file_id=%s WHERE imdb_id=%s;'
+
+# Mark the poster link of a movie as not usable (Telegram could not send it)
+UPDATE_MOVIE_POSTER_NOT_OK = 'UPDATE movies SET poster_ok=FALSE, poster_file_id=NULL WHERE imdb_id=%s;'
+
+# Create movie releases table (release date of a movie in each region, see REGIONS)
+CREATE_MOVIE_RELEASES_TABLE = 'CREATE TABLE IF NOT EXISTS movie_releases ( \
+    imdb_id varchar(20), \
+    region varchar(10), \
+    release_date date, \
+    PRIMARY KEY (imdb_id, region) \
+);'
+
+# Index movie releases by region and release date for the date range queries
+CREATE_MOVIE_RELEASES_REGION_DATE_INDEX = 'CREATE INDEX IF NOT EXISTS movie_releases_region_date_idx \
+                ON movie_releases (region, release_date);'
+
+# Copy the release dates of a movies table created before regions existed into the given region,
+# if there are no movie releases yet
+MIGRATE_MOVIE_RELEASES = 'INSERT INTO movie_releases (imdb_id, region, release_date) \
+                SELECT imdb_id, %s, release_date FROM movies \
+                WHERE NOT EXISTS (SELECT 1 FROM movie_releases);'
+
+# Insert or update the release dates of movies in regions (used with execute_values)
+UPSERT_MOVIE_RELEASES = 'INSERT INTO movie_releases (imdb_id, region, release_date) \
+                VALUES %s \
+                ON CONFLICT (imdb_id, region) DO UPDATE SET release_date=EXCLUDED.release_date;'
+
+# Delete movie releases before the given date
+DELETE_MOVIE_RELEASES_BEFORE = 'DELETE FROM movie_releases WHERE release_date < %s;'
+
+# Delete movies that are not released in any region anymore
+DELETE_MOVIES_WITHOUT_RELEASES = 'DELETE FROM movies \
+                WHERE NOT EXISTS (SELECT 1 FROM movie_releases WHERE movie_releases.imdb_id = movies.imdb_id);'
+
+# Delete the releases of a movie in every region
+DELETE_MOVIE_RELEASES = 'DELETE FROM movie_releases WHERE imdb_id=%s;'
+
 # Check if a movie exists in the movies table using its imdb_id
 CHECK_MOVIE_EXISTS = 'SELECT 1 FROM movies WHERE imdb_id=%s;'
 
-# Get movies
-GET_MOVIES = 'SELECT * FROM movies;'
+# Get the summary columns of the movies released in a region, with their release date in that region
+# (everything but the details loaded on demand)
+GET_MOVIE_SUMMARIES = 'SELECT m.imdb_id, m.title, m.year, m.imdb_link, r.release_date, m.poster_link, m.poster_ok, \
+                m.poster_file_id \
+                FROM movie_releases r JOIN movies m ON m.imdb_id = r.imdb_id WHERE r.region=%s;'
+
+# Get the summary columns of the movies released in a region between two dates (both included)
+GET_MOVIE_SUMMARIES_RELEASED_BETWEEN = 'SELECT m.imdb_id, m.title, m.year, m.imdb_link, r.release_date, m.poster_link, \
+                m.poster_ok, m.poster_file_id \
+                FROM movie_releases r JOIN movies m ON m.imdb_id = r.imdb_id \
+                WHERE r.region=%s AND r.release_date BETWEEN %s AND %s ORDER BY r.release_date;'
 
-# Get movies based on title (case-insensitive)
-GET_MOVIES_BY_TITLE = 'SELECT * FROM movies WHERE LOWER(title)=LOWER(%s);'
+# Get the summary columns of the movies released in a region before a date
+GET_MOVIE_SUMMARIES_RELEASED_BEFORE = 'SELECT m.imdb_id, m.title, m.year, m.imdb_link, r.release_date, m.poster_link, \
+                m.poster_ok, m.poster_file_id \
+                FROM movie_releases r JOIN movies m ON m.imdb_id = r.imdb_id \
+                WHERE r.region=%s AND r.release_date < %s ORDER BY r.release_date;'
+
+# Get the detail columns of the movies with the given imdb_ids
+GET_MOVIE_DETAILS = 'SELECT imdb_id, run_time, genre, director, writer, actors, plot, language, country \
+                FROM movies WHERE imdb_id = ANY(%s);'
 
 # Delete a movie object from the movies table
 DELETE_MOVIE = 'DELETE FROM movies WHERE imdb_id=%s;'
@@ -50,13 +132,128 @@ CREATE_USERS_TABLE = 'CREATE TABLE IF NOT EXISTS users ( \
     username varchar(50) \
 );'
 
+# Add the region column to a users table created before it existed (NULL for the default region)
+ADD_USERS_REGION_COLUMN = 'ALTER TABLE users ADD COLUMN IF NOT EXISTS region varchar(10);'
+
 # Insert a user object in the users table
 INSERT_USER = 'INSERT INTO users (chat_id, first_name, username) \
                 VALUES (%s, %s, %s) \
                 ON CONFLICT DO NOTHING;'
 
+# Insert several users in the users table (execute_values), returning the chat_ids of the inserted users
+INSERT_USERS = 'INSERT INTO users (chat_id, first_name, username) \
+                VALUES %s \
+                ON CONFLICT DO NOTHING \
+                RETURNING chat_id;'
+
 # Get users
-GET_USERS = 'SELECT * FROM users;'
+GET_USERS = 'SELECT chat_id, first_name, username, region FROM users;'
+
+# Get the chat_id and region of all the users
+GET_USER_REGIONS = 'SELECT chat_id, region FROM users;'
+
+# Get the first page of users, ordered by chat_id
+GET_USERS_FIRST_PAGE = 'SELECT chat_id, first_name, username, region FROM users ORDER BY chat_id LIMIT %s;'
+
+# Get the page of users following the given chat_id, ordered by chat_id
+GET_USERS_PAGE_AFTER = 'SELECT chat_id, first_name, username, region FROM users \
+                WHERE chat_id > %s ORDER BY chat_id LIMIT %s;'
+
+# Set the region of a user
+UPDATE_USER_REGION = 'UPDATE users SET region=%s WHERE chat_id=%s;'
 
 # Delete a user object from the movies table
-DELETE_USER = 'DELETE FROM users WHERE chat_id=%s;'
\ No newline at end of file
+DELETE_USER = 'DELETE FROM users WHERE chat_id=%s;'
+
+# Delete users with the given chat_ids
+DELETE_USERS = 'DELETE FROM users WHERE chat_id = ANY(%s);'
+
+# Create OMDb response cache table
+CREATE_OMDB_CACHE_TABLE = 'CREATE TABLE IF NOT EXISTS omdb_cache ( \
+    imdb_id varchar(20) PRIMARY KEY, \
+    details text, \
+    expires_at timestamp \
+);'
+
+# Get cached OMDb responses of the given imdb_ids
+GET_OMDB_CACHE = 'SELECT imdb_id, details, expires_at FROM omdb_cache WHERE imdb_id = ANY(%s);'
+
+# Insert or replace cached OMDb responses (used with execute_values)
+UPSERT_OMDB_CACHE = 'INSERT INTO omdb_cache (imdb_id, details, expires_at) \
+                VALUES %s \
+                ON CONFLICT (imdb_id) DO UPDATE SET details=EXCLUDED.details, expires_at=EXCLUDED.expires_at;'
+
+# Remove cached OMDb responses of titles that are not in the given imdb_ids
+EVICT_OMDB_CACHE = 'DELETE FROM omdb_cache WHERE NOT (imdb_id = ANY(%s));'
+
+# Create job runs table (leases of the scheduled jobs, see leadership.py)
+CREATE_JOB_RUNS_TABLE = 'CREATE TABLE IF NOT EXISTS job_runs ( \
+    job_name varchar(50), \
+    run_key varchar(50), \
+    owner text, \
+    lease_until timestamptz, \
+    completed boolean, \
+    PRIMARY KEY (job_name, run_key) \
+);'
+
+# Claim the lease of a job run if nobody holds it and it is not completed. Returns a row if claimed.
+CLAIM_JOB_RUN = "INSERT INTO job_runs (job_name, run_key, owner, lease_until, completed) \
+                VALUES (%s, %s, %s, now() + %s * interval '1 second', false) \
+                ON CONFLICT (job_name, run_key) DO UPDATE SET owner=EXCLUDED.owner, lease_until=EXCLUDED.lease_until \
+                WHERE job_runs.completed = false AND job_runs.lease_until < now() \
+                RETURNING owner;"
+
+# Get whether a job run is completed and the number of seconds left on its lease
+GET_JOB_RUN = 'SELECT completed, EXTRACT(EPOCH FROM lease_until - now()) FROM job_runs \
+                WHERE job_name=%s AND run_key=%s;'
+
+# Extend the lease of a job run held by the given owner
+RENEW_JOB_RUN = "UPDATE job_runs SET lease_until = now() + %s * interval '1 second' \
+                WHERE job_name=%s AND run_key=%s AND owner=%s AND completed = false;"
+
+# Release the lease of a job run held by the given owner, marking it completed or not
+FINISH_JOB_RUN = 'UPDATE job_runs SET completed=%s, lease_until=now() \
+                WHERE job_name=%s AND run_key=%s AND owner=%s;'
+
+# Create sync state table (key/value state of the movies update, e.g. validators of the last IMDB calendar response)
+CREATE_SYNC_STATE_TABLE = 'CREATE TABLE IF NOT EXISTS sync_state ( \
+    key varchar(50) PRIMARY KEY, \
+    value text, \
+    updated_at timestamptz DEFAULT now() \
+);'
+
+# Get all the sync state values
+GET_SYNC_STATE = 'SELECT key, value FROM sync_state;'
+
+# Get one sync state value
+GET_SYNC_STATE_VALUE = 'SELECT value FROM sync_state WHERE key=%s;'
+
+# Insert or replace sync state values (used with execute_values)
+UPSERT_SYNC_STATE = 'INSERT INTO sync_state (key, value) \
+                VALUES %s \
+                ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=now();'
+
+# Create subscriptions table (genres and languages of the movies a user is notified of)
+CREATE_SUBSCRIPTIONS_TABLE = 'CREATE TABLE IF NOT EXISTS subscriptions ( \
+    chat_id integer, \
+    kind varchar(20), \
+    token varchar(50), \
+    PRIMARY KEY (chat_id, kind, token) \
+);'
+
+# Get all subscriptions
+GET_SUBSCRIPTIONS = 'SELECT chat_id, kind, token FROM subscriptions;'
+
+# Get the subscriptions of a user
+GET_USER_SUBSCRIPTIONS = 'SELECT kind, token FROM subscriptions WHERE chat_id=%s ORDER BY kind, token;'
+
+# Insert a subscription
+INSERT_SUBSCRIPTION = 'INSERT INTO subscriptions (chat_id, kind, token) \
+                VALUES (%s, %s, %s) \
+                ON CONFLICT DO NOTHING;'
+
+# Delete a subscription
+DELETE_SUBSCRIPTION = 'DELETE FROM subscriptions WHERE chat_id=%s AND kind=%s AND token=%s;'
+
+# Delete the subscriptions of the users with the given chat_ids
+DELETE_USERS_SUBSCRIPTIONS = 'DELETE FROM subscriptions WHERE chat_id = ANY(%s);'
\ No newline at end of file
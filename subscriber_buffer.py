@@ -0,0 +1,227 @@
+"""
+Buffers the /start and /stop of users and writes them to the database in batches
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger()
+
+class SubscriberBuffer:
+    '''
+    Write-behind buffer of the users table.
+    /start and /stop are answered from an in-memory map of the subscribed chat_ids (to their region, so that
+    commands do not have to query the region of the user), and the changes are
+    coalesced per chat_id and written by a background thread every flush_interval seconds (or as soon as
+    flush_size changes are pending), as one multi-row DELETE and one multi-row INSERT.
+    The map is reloaded from the database every reload_interval seconds, to pick up the changes made by
+    other instances of the bot.
+    If a batch is rejected because of its values (db_mgr.ROW_ERRORS, e.g. a first name too long for its column),
+    it is written again in halves until the rejected changes are isolated, and these are logged and dropped.
+    '''
+
+    def __init__(self, db_mgr, flush_interval=None, flush_size=None, reload_interval=None):
+        self.db_mgr = db_mgr
+        self.flush_interval = flush_interval or float(os.getenv('SUBSCRIBER_FLUSH_SECONDS', 1))
+        self.flush_size = flush_size or int(os.getenv('SUBSCRIBER_FLUSH_SIZE', 500))
+        self.reload_interval = reload_interval or float(os.getenv('SUBSCRIBER_RELOAD_MINUTES', 10)) * 60
+        self.user_regions = {} # chat_id -> region (None for the default region) of the subscribed users
+        self.pending_deletes = set() # chat_ids to delete, written before the inserts
+        self.pending_inserts = {} # chat_id -> User to insert
+        self.last_reload = None # time.monotonic() of the last reload of user_regions
+        self.lock = threading.Lock() # Guards user_regions and the pending changes
+        self.flush_lock = threading.Lock() # One flush at a time, so that batches are written in order
+        self.wake = threading.Event() # Set to flush right away (flush_size reached or closing)
+        self.closed = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''
+        Load the subscribed users and start flushing in the background. Returns self.
+        '''
+        self.reload()
+        self.thread = threading.Thread(target=self.__flush_loop, name='subscriber-buffer', daemon=True)
+        self.thread.start()
+        return self
+
+    def add(self, user):
+        '''
+        Subscribe a user. Returns True if the user was not subscribed, False if already subscribed.
+        '''
+        with self.lock:
+            if user.chat_id in self.user_regions:
+                return False
+            self.user_regions[user.chat_id] = None
+            self.pending_inserts[user.chat_id] = user
+            self.__wake_if_full()
+        return True
+
+    def remove(self, chat_id):
+        '''
+        Unsubscribe a user. Returns True if the user was subscribed, False if not.
+        '''
+        with self.lock:
+            if chat_id not in self.user_regions:
+                return False
+            del self.user_regions[chat_id]
+            self.pending_inserts.pop(chat_id, None)
+            self.pending_deletes.add(chat_id)
+            self.__wake_if_full()
+        return True
+
+    def discard(self, chat_ids):
+        '''
+        Forget users already removed from the database (e.g. users who blocked the bot).
+        '''
+        with self.lock:
+            for chat_id in chat_ids:
+                self.user_regions.pop(chat_id, None)
+                self.pending_inserts.pop(chat_id, None)
+
+    def get_region(self, chat_id):
+        '''
+        Returns the region of a subscribed user, None if the user has not picked one or is not subscribed.
+        '''
+        return self.user_regions.get(chat_id)
+
+    def set_region(self, chat_id, region):
+        '''
+        Remember the region of a user, once it is stored in the database.
+        '''
+        with self.lock:
+            self.user_regions[chat_id] = region
+
+    def is_pending(self, chat_id):
+        '''
+        Returns True if a change of the user is not written to the database yet.
+        '''
+        with self.lock:
+            return chat_id in self.pending_inserts or chat_id in self.pending_deletes
+
+    def flush(self):
+        '''
+        Write the pending changes to the database, in the calling thread.
+        Changes rejected because of their values are dropped. If the write fails for another reason, the changes
+        not written yet are kept pending and the error is raised.
+        Returns (number of inserted users, number of removed users).
+        '''
+        with self.flush_lock:
+            with self.lock:
+                deletes, inserts = self.pending_deletes, self.pending_inserts
+                self.pending_deletes, self.pending_inserts = set(), {}
+            if not deletes and not inserts:
+                return 0, 0
+            users = list(inserts.values())
+            try:
+                return self.db_mgr.write_users(users, deletes)
+            except self.db_mgr.ROW_ERRORS:
+                LOGGER.warning("Failed to write {} subscriber changes at once, writing them in smaller batches"
+                                .format(len(users) + len(deletes)))
+            except Exception:
+                self.__requeue([(users, deletes)])
+                raise
+            return self.__write_split(users, list(deletes))
+
+    def __write_split(self, users, deletes):
+        '''
+        Write the users to insert and the chat_ids to delete (deletes first) in batches halved on every rejection,
+        dropping the single changes rejected. Returns (number of inserted users, number of removed users).
+        '''
+        inserted_count, deleted_count = 0, 0
+        batches = collections.deque([([], deletes), (users, [])]) # Each batch either inserts or deletes
+        while batches:
+            batch_users, batch_deletes = batches.popleft()
+            size = len(batch_users) + len(batch_deletes)
+            if size == 0:
+                continue
+            try:
+                inserted, deleted = self.db_mgr.write_users(batch_users, batch_deletes)
+                inserted_count += inserted
+                deleted_count += deleted
+            except self.db_mgr.ROW_ERRORS as error:
+                if size == 1:
+                    self.__drop(batch_users, batch_deletes, error)
+                    continue
+                half = size // 2
+                if batch_users:
+                    batches.extendleft([(batch_users[half:], []), (batch_users[:half], [])])
+                else:
+                    batches.extendleft([([], batch_deletes[half:]), ([], batch_deletes[:half])])
+            except Exception:
+                batches.appendleft((batch_users, batch_deletes))
+                self.__requeue(batches)
+                raise
+        return inserted_count, deleted_count
+
+    def __drop(self, users, deletes, error):
+        '''
+        Give up on a change rejected by the database.
+        '''
+        for user in users:
+            LOGGER.error("Dropped the subscription of {}, rejected by the database: {}".format(user, error))
+            with self.lock:
+                if user.chat_id not in self.pending_inserts: # Not subscribed, unless /start was sent again since
+                    self.user_regions.pop(user.chat_id, None)
+        for chat_id in deletes:
+            LOGGER.error("Dropped the removal of user {}, rejected by the database: {}".format(chat_id, error))
+
+    def __requeue(self, batches):
+        '''
+        Make the (users, deleted chat_ids) batches pending again, after a failed write.
+        '''
+        with self.lock:
+            # Changes made since then come after the failed batches
+            for users, deletes in batches:
+                for user in users:
+                    if user.chat_id not in self.pending_deletes:
+                        self.pending_inserts.setdefault(user.chat_id, user)
+                self.pending_deletes.update(deletes)
+
+    def reload(self):
+        '''
+        Load the subscribed users from the database, keeping the changes not written yet.
+        '''
+        with self.flush_lock:
+            user_regions = self.db_mgr.get_user_regions()
+            with self.lock:
+                for chat_id in self.pending_deletes:
+                    user_regions.pop(chat_id, None)
+                for chat_id in self.pending_inserts:
+                    user_regions[chat_id] = None
+                self.user_regions = user_regions
+                self.last_reload = time.monotonic()
+
+    def close(self):
+        '''
+        Stop the background thread and write the remaining changes.
+        '''
+        self.closed.set()
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+        try:
+            self.flush()
+        except Exception:
+            LOGGER.exception("Failed to write the last subscriber changes")
+
+    def __wake_if_full(self):
+        if len(self.pending_inserts) + len(self.pending_deletes) >= self.flush_size:
+            self.wake.set()
+
+    def __flush_loop(self):
+        while not self.closed.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            if self.closed.is_set():
+                return
+            try:
+                inserted_count, deleted_count = self.flush()
+                if inserted_count or deleted_count:
+                    LOGGER.info("Wrote subscriber changes: {} added, {} removed".format(inserted_count, deleted_count))
+                if time.monotonic() - self.last_reload >= self.reload_interval:
+                    self.reload()
+            except Exception:
+                LOGGER.exception("Failed to write subscriber changes, retrying in {}s".format(self.flush_interval))
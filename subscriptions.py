@@ -0,0 +1,71 @@
+"""
+Genre and language subscriptions, used to pick the movies of each user's morning digest
+"""
+
+import unidecode
+
+KINDS = ('genre', 'language') # Movie fields a user can subscribe to
+
+def normalize_token(value):
+    '''
+    Returns the form of a genre or language used for matching (ASCII, lowercase, single spaces).
+    '''
+    return ' '.join(unidecode.unidecode(value).lower().split())
+
+def movie_tokens(movie):
+    '''
+    Returns the set of (kind, token) of a movie, e.g. {('genre', 'action'), ('language', 'english')}.
+    The detail fields of the movie must be loaded.
+    '''
+    tokens = set()
+    for kind in KINDS:
+        for value in (getattr(movie, kind) or '').split(','):
+            token = normalize_token(value)
+            if token and token != 'n/a':
+                tokens.add((kind, token))
+    return tokens
+
+class SubscriptionIndex:
+    '''
+    Inverted index from each (kind, token) to the chat_ids subscribed to it.
+    Chats without any subscription receive every movie.
+    '''
+
+    def __init__(self, subscriptions):
+        '''
+        @param subscriptions: Iterable of (chat_id, kind, token) tuples.
+        '''
+        self.subscribers = {} # (kind, token) -> set of chat_ids
+        self.subscribed_chat_ids = set()
+        for chat_id, kind, token in subscriptions:
+            self.subscribers.setdefault((kind, normalize_token(token)), set()).add(chat_id)
+            self.subscribed_chat_ids.add(chat_id)
+
+    def match(self, movies):
+        '''
+        Returns the movies matching the subscriptions of each chat, as a dict of chat_id -> tuple of indexes in movies.
+        Only the subscribed chats matching at least one movie are included.
+        '''
+        matches = {}
+        for i, movie in enumerate(movies):
+            chat_ids = set().union(*(self.subscribers.get(token, ()) for token in movie_tokens(movie)))
+            for chat_id in chat_ids:
+                matches.setdefault(chat_id, []).append(i)
+        return {chat_id: tuple(indexes) for chat_id, indexes in matches.items()}
+
+    def digests(self, movies):
+        '''
+        Returns a function mapping a chat_id to the indexes (tuple) of the movies of its digest.
+        Chats with identical digests get equal tuples, which can be used to render each distinct digest once.
+        '''
+        matches = self.match(movies)
+        all_movies = tuple(range(len(movies)))
+
+        def digest(chat_id):
+            if chat_id not in self.subscribed_chat_ids:
+                return all_movies
+            return matches.get(chat_id, ())
+        return digest
+
+    def __len__(self):
+        return len(self.subscribed_chat_ids)
@@ -0,0 +1,53 @@
+"""
+Checks the title search of the movie catalog, including typos
+"""
+
+from catalog import MovieCatalog
+from catalog import edit_distance
+from movie import Movie
+import datetime
+import pytest
+
+TITLES = ['Tenet', 'Avengers: Endgame', 'The Avengers', 'Bill & Ted Face the Music', 'Wonder Woman 1984',
+            'The Tender Bar', "Le fabuleux destin d'Amélie Poulain", 'It']
+
+@pytest.fixture
+def catalog():
+    first_release = datetime.datetime(2020, 9, 17)
+    movies = [Movie(title=title, imdb_id='tt{:07d}'.format(i), release_date=first_release + datetime.timedelta(days=i))
+                for i, title in enumerate(TITLES)]
+    return MovieCatalog(movies)
+
+def search_titles(catalog, query):
+    return [movie.title for _, movie in catalog.search_movies(query)]
+
+def test_edit_distance():
+    assert edit_distance('tenet', 'tenet') == 0
+    assert edit_distance('teent', 'tenet') == 1 # Swapped letters
+    assert edit_distance('endgme', 'endgame') == 1
+    assert edit_distance('avangers', 'avengers') == 1
+    assert edit_distance('kitten', 'sitting') == 3
+
+def test_exact_and_prefix_matches_come_first(catalog):
+    assert search_titles(catalog, 'tenet')[0] == 'Tenet'
+    assert search_titles(catalog, 'Bill & Ted')[0] == 'Bill & Ted Face the Music'
+    assert search_titles(catalog, 'amelie')[0] == "Le fabuleux destin d'Amélie Poulain"
+
+def test_swapped_letters(catalog):
+    assert search_titles(catalog, 'teent')[0] == 'Tenet'
+
+def test_missing_letter_in_one_word_of_the_title(catalog):
+    assert search_titles(catalog, 'endgme')[0] == 'Avengers: Endgame'
+
+def test_typo_finds_every_title_with_the_word(catalog):
+    titles = search_titles(catalog, 'avangers')
+    assert 'Avengers: Endgame' in titles
+    assert 'The Avengers' in titles
+
+def test_typos_in_several_words(catalog):
+    assert search_titles(catalog, 'wondr women')[0] == 'Wonder Woman 1984'
+    assert search_titles(catalog, 'the avangers')[0] == 'The Avengers'
+
+def test_unrelated_query_finds_nothing(catalog):
+    assert search_titles(catalog, 'zzzzz') == []
+    assert search_titles(catalog, 'at') == []
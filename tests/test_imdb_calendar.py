@@ -0,0 +1,64 @@
+"""
+Checks that the streaming IMDB calendar parser finds the same releases as the BeautifulSoup parser
+on saved calendar pages
+"""
+
+from imdb_calendar import ImdbCalendarParser
+from imdb_calendar import soup_calendar_entries
+import codecs
+import os
+import pytest
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+FIXTURES = ['imdb_calendar_sg.html', 'imdb_calendar_empty.html']
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as fixture_file:
+        return fixture_file.read()
+
+def stream_entries(page, chunk_size):
+    '''
+    Feeds the page to ImdbCalendarParser in chunks of chunk_size bytes, as Releases does while downloading.
+    '''
+    parser = ImdbCalendarParser()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    entries = []
+    for start in range(0, len(page), chunk_size):
+        parser.feed(decoder.decode(page[start:start + chunk_size]))
+        entries += parser.entries
+        parser.entries = []
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return entries + parser.entries
+
+def normalize(entries):
+    '''
+    Collapses the whitespace of the entries as Releases does before building the movies
+    (BeautifulSoup already reduces whitespace-only strings to a line break).
+    '''
+    return [(date.strip(), ' '.join(text.split()), href) for date, text, href in entries]
+
+def test_streaming_parser_finds_the_releases_of_main_only():
+    entries = normalize(stream_entries(read_fixture('imdb_calendar_sg.html'), 1 << 16))
+    assert entries == [
+        ('17 September 2020', 'Tenet (2020)', '/title/tt6723592/?ref_=rlm'),
+        ('17 September 2020', 'Bill & Ted Face the Music (2020)', '/title/tt1086064/?ref_=rlm'),
+        ('24 September 2020', "Le fabuleux destin d'Amélie Poulain (2001)", '/title/tt0211915/?ref_=rlm'),
+        ('24 September 2020', 'Wonder Woman 1984 (2020)', '/title/tt7126948/?ref_=rlm'),
+        ('24 September 2020', '反贪风暴4 (2019)', '/title/tt10309930/?ref_=rlm'),
+        ('1 October 2020', 'The Avengers (2012)', '/title/tt0848228/?ref_=rlm'),
+    ]
+
+def test_streaming_parser_without_releases():
+    assert stream_entries(read_fixture('imdb_calendar_empty.html'), 1 << 16) == []
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 512])
+def test_streaming_parser_does_not_depend_on_chunk_boundaries(chunk_size):
+    page = read_fixture('imdb_calendar_sg.html')
+    assert stream_entries(page, chunk_size) == stream_entries(page, len(page))
+
+@pytest.mark.parametrize('fixture', FIXTURES)
+def test_streaming_parser_matches_soup_parser(fixture):
+    pytest.importorskip('bs4')
+    page = read_fixture(fixture)
+    assert normalize(stream_entries(page, 4096)) == normalize(soup_calendar_entries(page))
@@ -0,0 +1,43 @@
+"""
+Checks the pagination of the /listall message
+"""
+
+from listall import render_listall_pages
+from movie import Movie
+import datetime
+
+def make_movies(count, per_date):
+    first_release = datetime.datetime(2020, 9, 17)
+    return [Movie(title='Movie number {}'.format(i), release_date=first_release + datetime.timedelta(days=i // per_date))
+            for i in range(count)]
+
+def test_single_page():
+    pages = render_listall_pages(make_movies(3, 2), 'Singapore')
+    assert len(pages) == 1
+    assert pages[0].startswith("Here are the upcoming movie releases in Singapore.")
+    assert "<b>17 September 2020</b>\n🎬 Movie number 0\n🎬 Movie number 1" in pages[0]
+
+def test_pages_fit_the_limit_and_keep_every_movie():
+    movies = make_movies(200, 30)
+    pages = render_listall_pages(movies, max_page_length=1000)
+    assert len(pages) > 3
+    assert all(len(page) <= 1000 for page in pages)
+    listed = [line[2:] for page in pages for line in page.split("\n") if line.startswith("🎬 ")]
+    assert listed == [movie.title for movie in movies]
+
+def test_every_page_starts_with_a_date():
+    pages = render_listall_pages(make_movies(200, 30), max_page_length=1000)
+    for page in pages[1:]:
+        first_line = page.strip("\n").split("\n")[0]
+        assert first_line.startswith("<b>") and first_line.endswith(("</b>", "</b> (continued)")), first_line
+
+def test_page_break_inside_a_date_repeats_it():
+    pages = render_listall_pages(make_movies(200, 200), max_page_length=1000)
+    assert len(pages) > 1
+    for page in pages[1:]:
+        assert page.startswith("<b>17 September 2020</b> (continued)\n🎬 ")
+
+def test_date_is_not_left_alone_at_the_end_of_a_page():
+    pages = render_listall_pages(make_movies(200, 3), max_page_length=500)
+    for page in pages:
+        assert page.split("\n")[-1].startswith("🎬 ")
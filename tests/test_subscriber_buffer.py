@@ -0,0 +1,94 @@
+"""
+Checks that the subscriber buffer isolates the changes rejected by the database
+"""
+
+from subscriber_buffer import SubscriberBuffer
+from user import User
+import pytest
+
+class RowError(Exception):
+    pass
+
+class StubDatabase:
+    '''
+    Stands for DatabaseManager: rejects every batch holding a chat_id of bad_chat_ids, and raises
+    ConnectionError on every write while down.
+    '''
+
+    ROW_ERRORS = (RowError, )
+
+    def __init__(self, bad_chat_ids=()):
+        self.bad_chat_ids = set(bad_chat_ids)
+        self.down = False
+        self.users = {}
+        self.writes = 0
+
+    def get_user_regions(self):
+        return {chat_id: None for chat_id in self.users}
+
+    def write_users(self, users, deleted_chat_ids):
+        self.writes += 1
+        if self.down:
+            raise ConnectionError("database unreachable")
+        chat_ids = set(deleted_chat_ids) | {user.chat_id for user in users}
+        if chat_ids & self.bad_chat_ids:
+            raise RowError("value out of range")
+        deleted = [chat_id for chat_id in deleted_chat_ids if self.users.pop(chat_id, None)]
+        inserted = [user for user in users if self.users.setdefault(user.chat_id, user) is user]
+        return len(inserted), len(deleted)
+
+def make_buffer(db):
+    buffer = SubscriberBuffer(db, flush_interval=60, flush_size=1000)
+    buffer.reload()
+    return buffer
+
+def test_flush_writes_every_change():
+    db = StubDatabase()
+    buffer = make_buffer(db)
+    for chat_id in range(10):
+        buffer.add(User(chat_id, 'user', None))
+    buffer.remove(3)
+    assert buffer.flush() == (9, 0)
+    assert db.writes == 1
+    assert set(db.users) == set(range(10)) - {3}
+
+def test_flush_drops_the_rejected_changes_only():
+    db = StubDatabase(bad_chat_ids={-1001234567890, 7})
+    buffer = make_buffer(db)
+    for chat_id in list(range(20)) + [-1001234567890]:
+        buffer.add(User(chat_id, 'user', None))
+    assert buffer.flush() == (19, 0)
+    assert set(db.users) == set(range(20)) - {7}
+    assert not buffer.is_pending(7)
+    assert buffer.get_region(7) is None and 7 not in buffer.user_regions
+    assert buffer.flush() == (0, 0)
+
+def test_flush_keeps_the_changes_when_the_database_is_down():
+    db = StubDatabase()
+    buffer = make_buffer(db)
+    buffer.add(User(1, 'user', None))
+    buffer.add(User(2, 'user', None))
+    db.down = True
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+    assert buffer.is_pending(1) and buffer.is_pending(2)
+    db.down = False
+    assert buffer.flush() == (2, 0)
+
+def test_flush_keeps_the_unwritten_changes_when_the_database_goes_down_while_splitting():
+    db = StubDatabase(bad_chat_ids={0})
+    buffer = make_buffer(db)
+    for chat_id in range(4):
+        buffer.add(User(chat_id, 'user', None))
+    write_users = db.write_users
+
+    def write_users_then_go_down(users, deleted_chat_ids):
+        result = write_users(users, deleted_chat_ids)
+        db.down = True # Once user 1 is written, after user 0 is dropped
+        return result
+    db.write_users = write_users_then_go_down
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+    assert set(db.users) == {1}
+    assert not buffer.is_pending(0) and not buffer.is_pending(1)
+    assert buffer.is_pending(2) and buffer.is_pending(3)
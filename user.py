@@ -3,10 +3,13 @@ Represents a user that is subcribed to the bot
 """
 
 class User:
-    def __init__(self, chat_id, first_name, username):
+    __slots__ = ('chat_id', 'first_name', 'username', 'region')
+
+    def __init__(self, chat_id, first_name, username, region=None):
         self.chat_id = chat_id
         self.first_name = first_name
         self.username = username
-    
+        self.region = region # Region of the movie releases the user follows, None for the default region
+
     def __str__(self):
         return "(" + str(self.chat_id) + ", " + self.first_name + ")"
\ No newline at end of file